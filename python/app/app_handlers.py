@@ -1,28 +1,36 @@
+import os
 from http import HTTPStatus
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, HTTPException, Response
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from sqlalchemy import text
 from sqlalchemy.engine import Connection
 from ulid import ULID
 
+from .chair_index import chair_index
+from .chair_sales import record_chair_sale
+from .coupon_ledger import coupon_ledger
+from .loaders import Loaders
 from .middlewares import app_auth_middleware
 from .models import (
     Chair,
-    ChairLocation,
-    Owner,
     PaymentToken,
     Ride,
     RideStatus,
     User,
 )
-from .payment_gateway import (
-    PaymentGatewayPostPaymentRequest,
-    UpstreamError,
-    request_payment_gateway_post_payment,
+from .notifications import (
+    accepts_event_stream,
+    chair_notifications,
+    stream,
+    user_notifications,
 )
+from .payment_outbox import enqueue_payment, payment_dispatcher
 from .sql import engine
+from .token_table import token_table
+from .user_ride_counts import finish_ride, register_user, start_ride
 from .utils import (
     FARE_PER_DISTANCE,
     INITIAL_FARE,
@@ -34,6 +42,9 @@ from .utils import (
 
 router = APIRouter(prefix="/api/app")
 
+# ライド履歴を1ページで返す最大件数
+APP_RIDES_MAX_PAGE_SIZE = int(os.getenv("ISUCON_APP_RIDES_MAX_PAGE_SIZE", "100"))
+
 
 class AppPostUsersRequest(BaseModel):
     username: str
@@ -56,6 +67,7 @@ def app_post_users(
     access_token = secure_random_str(32)
     invitation_code = secure_random_str(15)
 
+    inviter_id: str | None = None
     with engine.begin() as conn:
         conn.execute(
             text(
@@ -71,6 +83,7 @@ def app_post_users(
                 "invitation_code": invitation_code,
             },
         )
+        register_user(conn, user_id)
 
         # 初回登録キャンペーンのクーポンを付与
         conn.execute(
@@ -119,6 +132,7 @@ def app_post_users(
             )
 
             # 招待した人にもRewardを付与
+            inviter_id = inviter.id
             conn.execute(
                 text(
                     "INSERT INTO coupons (user_id, code, discount) VALUES (:user_id, CONCAT(:code_prefix, '_', FLOOR(UNIX_TIMESTAMP(NOW(3))*1000)), :discount)"
@@ -130,6 +144,15 @@ def app_post_users(
                 },
             )
 
+        row = conn.execute(
+            text("SELECT * FROM users WHERE id = :id"), {"id": user_id}
+        ).fetchone()
+        user = User.model_validate(row)
+
+    token_table.put(access_token, user)
+    if inviter_id is not None:
+        coupon_ledger.changed(inviter_id)
+
     response.set_cookie(key="app_session", value=access_token, path="/")
     return AppPostUsersResponse(id=user_id, invitation_code=invitation_code)
 
@@ -182,50 +205,95 @@ class GetAppRidesResponseItem(BaseModel):
 
 class GetAppRidesResponse(BaseModel):
     rides: list[GetAppRidesResponseItem]
+    # limit か cursor を指定したときだけ返す。次のページが無ければ省く
+    next_cursor: str | None = None
 
 
-@router.get("/rides")
+@router.get("/rides", response_model_exclude_none=True)
 def app_get_rides(
     user: Annotated[User, Depends(app_auth_middleware)],
+    limit: int | None = None,
+    cursor: str | None = None,
 ) -> GetAppRidesResponse:
+    """
+    完了したライドを新しい順に返す。
+
+    limit と cursor のどちらも無ければ全件を返す。どちらかがあればページ単位で返し、
+    次のページは前のページの next_cursor (最後のライドのID) を cursor に指定して取る。
+    """
+    paginated = limit is not None or cursor is not None
+    if limit is None:
+        limit = APP_RIDES_MAX_PAGE_SIZE
+    if limit < 1 or limit > APP_RIDES_MAX_PAGE_SIZE:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail=f"limit must be between 1 and {APP_RIDES_MAX_PAGE_SIZE}",
+        )
+
     with engine.begin() as conn:
-        rows = conn.execute(
-            text(
-                "SELECT * FROM rides WHERE user_id = :user_id ORDER BY created_at DESC"
-            ),
-            {"user_id": user.id},
-        ).fetchall()
+        if not paginated:
+            rows = conn.execute(
+                text(
+                    "SELECT * FROM rides WHERE user_id = :user_id AND latest_status = 'COMPLETED' ORDER BY created_at DESC, id DESC"
+                ),
+                {"user_id": user.id},
+            ).fetchall()
+        else:
+            after = None
+            if cursor is not None:
+                after = conn.execute(
+                    text(
+                        "SELECT created_at FROM rides WHERE id = :id AND user_id = :user_id"
+                    ),
+                    {"id": cursor, "user_id": user.id},
+                ).scalar()
+                if after is None:
+                    raise HTTPException(
+                        status_code=HTTPStatus.BAD_REQUEST, detail="invalid cursor"
+                    )
+            # 次のページがあるかを知るために1件多く取る
+            rows = conn.execute(
+                text(
+                    "SELECT * FROM rides WHERE user_id = :user_id AND latest_status = 'COMPLETED' AND (:after IS NULL OR created_at < :after OR (created_at = :after AND id < :cursor)) ORDER BY created_at DESC, id DESC LIMIT :limit"
+                ),
+                {
+                    "user_id": user.id,
+                    "after": after,
+                    "cursor": cursor,
+                    "limit": limit + 1,
+                },
+            ).fetchall()
         rides = [Ride.model_validate(row) for row in rows]
 
+        next_cursor = None
+        if paginated and len(rides) > limit:
+            rides = rides[:limit]
+            next_cursor = rides[-1].id
+
+        # ライドごとに引いていた椅子・オーナー・クーポンを、種類ごとに1回のクエリで引く
+        loaders = Loaders(conn)
+        chairs = loaders.chairs.load_many(
+            ride.chair_id for ride in rides if ride.chair_id is not None
+        )
+        owners = loaders.owners.load_many(chair.owner_id for chair in chairs.values())
+        discounts = loaders.ride_discounts.load_many(ride.id for ride in rides)
+
         items = []
         for ride in rides:
-            status = get_latest_ride_status(conn, ride.id)
-            if status != "COMPLETED":
-                continue
-
-            fare = calculate_discounted_fare(
-                conn,
-                user.id,
-                ride,
+            fare = discounted_fare(
                 ride.pickup_latitude,
                 ride.pickup_longitude,
                 ride.destination_latitude,
                 ride.destination_longitude,
+                discounts.get(ride.id, 0),
             )
 
-            row = conn.execute(
-                text("SELECT * FROM chairs WHERE id = :id"), {"id": ride.chair_id}
-            ).fetchone()
-            if row is None:
+            chair = chairs.get(ride.chair_id or "")
+            if chair is None:
                 raise HTTPException(status_code=HTTPStatus.INTERNAL_SERVER_ERROR)
-            chair = Chair.model_validate(row)
-
-            row = conn.execute(
-                text("SELECT * FROM owners WHERE id = :id"), {"id": chair.owner_id}
-            ).fetchone()
-            if row is None:
+            owner = owners.get(chair.owner_id)
+            if owner is None:
                 raise HTTPException(status_code=HTTPStatus.INTERNAL_SERVER_ERROR)
-            owner = Owner.model_validate(row)
 
             item = GetAppRidesResponseItem(
                 id=ride.id,
@@ -246,7 +314,7 @@ def app_get_rides(
             )
             items.append(item)
 
-    return GetAppRidesResponse(rides=items)
+    return GetAppRidesResponse(rides=items, next_cursor=next_cursor)
 
 
 class AppPostRidesRequest(BaseModel):
@@ -259,21 +327,33 @@ class AppPostRidesResponse(BaseModel):
     fare: int
 
 
-def get_latest_ride_status(conn: Connection, ride_id: str) -> str:
-    status = conn.execute(
+def append_ride_statuses(conn: Connection, statuses: list[tuple[str, str]]) -> None:
+    """
+    (ライドID, 状態) を ride_statuses に追加し、同じトランザクションで rides.latest_status も進める。
+
+    状態の変化はライドの更新日時には含めないので、updated_at はそのままにする。
+    """
+    if not statuses:
+        return
+    conn.execute(
         text(
-            "SELECT status FROM ride_statuses WHERE ride_id = :ride_id ORDER BY created_at DESC LIMIT 1"
+            "INSERT INTO ride_statuses (id, ride_id, status) VALUES (:id, :ride_id, :status)"
         ),
-        {"ride_id": ride_id},
-    ).scalar()
+        [
+            {"id": str(ULID()), "ride_id": ride_id, "status": status}
+            for ride_id, status in statuses
+        ],
+    )
+    conn.execute(
+        text(
+            "UPDATE rides SET latest_status = :status, updated_at = updated_at WHERE id = :ride_id"
+        ),
+        [{"ride_id": ride_id, "status": status} for ride_id, status in statuses],
+    )
 
-    if status is None:
-        raise HTTPException(
-            status_code=HTTPStatus.INTERNAL_SERVER_ERROR, detail="no rows in result set"
-        )
 
-    assert isinstance(status, str)
-    return status
+def append_ride_status(conn: Connection, ride_id: str, status: str) -> None:
+    append_ride_statuses(conn, [(ride_id, status)])
 
 
 @router.post("/rides", status_code=HTTPStatus.ACCEPTED)
@@ -289,18 +369,7 @@ def app_post_rides(
 
     ride_id = str(ULID())
     with engine.begin() as conn:
-        rows = conn.execute(
-            text("SELECT * FROM rides WHERE user_id = :user_id"), {"user_id": user.id}
-        ).fetchall()
-        rides = [Ride.model_validate(row) for row in rows]
-
-        continuing_ride_count = 0
-        for ride in rides:
-            status = get_latest_ride_status(conn, ride.id)
-            if status != "COMPLETED":
-                continuing_ride_count += 1
-
-        if continuing_ride_count > 0:
+        if not start_ride(conn, user.id):
             raise HTTPException(
                 status_code=HTTPStatus.CONFLICT, detail="ride already exists"
             )
@@ -319,6 +388,7 @@ def app_post_rides(
             },
         )
 
+        # rides.latest_status は既定値の MATCHING になっている
         conn.execute(
             text(
                 "INSERT INTO ride_statuses (id, ride_id, status) VALUES (:id, :ride_id, :status)"
@@ -326,57 +396,8 @@ def app_post_rides(
             {"id": str(ULID()), "ride_id": ride_id, "status": "MATCHING"},
         )
 
-        ride_count = conn.execute(
-            text("SELECT COUNT(*) FROM rides WHERE user_id = :user_id"),
-            {"user_id": user.id},
-        ).scalar()
-
-        if ride_count == 1:
-            # 初回利用で、初回利用クーポンがあれば必ず使う
-            coupon = conn.execute(
-                text(
-                    "SELECT * FROM coupons WHERE user_id = :user_id AND code = 'CP_NEW2024' AND used_by IS NULL FOR UPDATE"
-                ),
-                {"user_id": user.id},
-            ).fetchone()
-
-            if coupon:
-                conn.execute(
-                    text(
-                        "UPDATE coupons SET used_by = :ride_id WHERE user_id = :user_id AND code = 'CP_NEW2024'"
-                    ),
-                    {"ride_id": ride_id, "user_id": user.id},
-                )
-            else:
-                # 無ければ他のクーポンを付与された順番に使う
-                coupon = conn.execute(
-                    text(
-                        "SELECT * FROM coupons WHERE user_id = :user_id AND used_by IS NULL ORDER BY created_at LIMIT 1 FOR UPDATE"
-                    ),
-                    {"user_id": user.id},
-                ).fetchone()
-                if coupon:
-                    conn.execute(
-                        text(
-                            "UPDATE coupons SET used_by = :ride_id WHERE user_id = :user_id AND code = :code"
-                        ),
-                        {"ride_id": ride_id, "user_id": user.id, "code": coupon.code},
-                    )
-        else:
-            # 他のクーポンを付与された順番に使う
-            coupon = conn.execute(
-                text(
-                    "SELECT * FROM coupons WHERE user_id = :user_id AND used_by IS NULL ORDER BY created_at LIMIT 1 FOR UPDATE"
-                ),
-                {"user_id": user.id},
-            ).fetchone()
-            if coupon:
-                conn.execute(
-                    text(
-                        "UPDATE coupons SET used_by = :ride_id WHERE user_id = :user_id AND code = :code"
-                    ),
-                    {"ride_id": ride_id, "user_id": user.id, "code": coupon.code},
-                )
+        # 初回利用クーポンがあれば必ず使い、無ければ他のクーポンを付与された順番に使う
+        coupon_ledger.redeem(conn, user.id, ride_id)
 
         row = conn.execute(
             text("SELECT * FROM rides WHERE id = :ride_id"), {"ride_id": ride_id}
@@ -393,6 +414,8 @@ def app_post_rides(
             req.destination_coordinate.longitude,
         )
 
+    coupon_ledger.changed(user.id)
+    user_notifications.publish(user.id)
     return AppPostRidesResponse(ride_id=ride_id, fare=fare)
 
 
@@ -468,7 +491,8 @@ def app_post_ride_evaluation(
 
     with engine.begin() as conn:
         row = conn.execute(
-            text("SELECT * FROM rides WHERE id = :ride_id"), {"ride_id": ride_id}
+            text("SELECT * FROM rides WHERE id = :ride_id FOR UPDATE"),
+            {"ride_id": ride_id},
         ).fetchone()
 
         if row is None:
@@ -476,9 +500,8 @@ def app_post_ride_evaluation(
                 status_code=HTTPStatus.NOT_FOUND, detail="ride not found"
             )
         ride = Ride.model_validate(row)
-        status = get_latest_ride_status(conn, ride.id)
 
-        if status != "ARRIVED":
+        if ride.latest_status != "ARRIVED":
             raise HTTPException(
                 status_code=HTTPStatus.BAD_REQUEST, detail="not arrived yet"
             )
@@ -492,11 +515,13 @@ def app_post_ride_evaluation(
                 status_code=HTTPStatus.NOT_FOUND, detail="ride not found"
             )
 
+        append_ride_status(conn, ride_id, "COMPLETED")
+        finish_ride(conn, ride.user_id)
         conn.execute(
             text(
-                "INSERT INTO ride_statuses (id, ride_id, status) VALUES (:id, :ride_id, :status)"
+                "INSERT INTO chair_stats (chair_id, total_rides_count, total_evaluation) VALUES (:chair_id, 1, :evaluation) ON DUPLICATE KEY UPDATE total_rides_count = total_rides_count + 1, total_evaluation = total_evaluation + VALUES(total_evaluation)"
             ),
-            {"id": str(ULID()), "ride_id": ride_id, "status": "COMPLETED"},
+            {"chair_id": ride.chair_id, "evaluation": req.evaluation},
         )
 
         row = conn.execute(
@@ -507,6 +532,7 @@ def app_post_ride_evaluation(
                 status_code=HTTPStatus.NOT_FOUND, detail="ride not found"
             )
         ride = Ride.model_validate(row)
+        record_chair_sale(conn, ride)
 
         row = conn.execute(
             text("SELECT * FROM payment_tokens WHERE user_id = :user_id"),
@@ -529,35 +555,16 @@ def app_post_ride_evaluation(
             ride.destination_longitude,
         )
 
-        payment_gateway_request = PaymentGatewayPostPaymentRequest(amount=fare)
-        payment_gateway_url = conn.execute(
-            text("SELECT value FROM settings WHERE name = 'payment_gateway_url'")
-        ).scalar()
-        if not isinstance(payment_gateway_url, str):
-            raise HTTPException(status_code=HTTPStatus.INTERNAL_SERVER_ERROR)
-
-        def retrieve_rides_order_by_created_at_asc() -> list[Ride]:
-            rows = conn.execute(
-                text(
-                    "SELECT * FROM rides WHERE user_id = :user_id ORDER BY created_at ASC",
-                ),
-                {"user_id": ride.user_id},
-            ).fetchall()
-            return [Ride.model_validate(r) for r in rows]
-
-        try:
-            request_payment_gateway_post_payment(
-                payment_gateway_url,
-                payment_token.token,
-                payment_gateway_request,
-                retrieve_rides_order_by_created_at_asc,
-            )
-        except UpstreamError as e:
-            raise HTTPException(status_code=HTTPStatus.BAD_GATEWAY, detail=str(e))
+        # 決済ゲートウェイへの送信はコミット後に payment_dispatcher が行う
+        enqueue_payment(conn, ride.id, ride.user_id, payment_token.token, fare)
 
         response = AppPostRideEvaluationResponse(
             completed_at=timestamp_millis(ride.updated_at)
         )
+    payment_dispatcher.wake()
+    user_notifications.publish(ride.user_id)
+    if ride.chair_id is not None:
+        chair_notifications.publish(ride.chair_id)
     return response
 
 
@@ -589,94 +596,118 @@ class AppGetNotificationResponse(BaseModel):
     retry_after_ms: int | None = None
 
 
-@router.get(
-    "/notification",
-    status_code=HTTPStatus.OK,
-    response_model_exclude_none=True,
-)
-def app_get_notification(
-    user: Annotated[User, Depends(app_auth_middleware)],
-) -> AppGetNotificationResponse:
-    with engine.begin() as conn:
-        row = conn.execute(
-            text(
-                "SELECT * FROM rides WHERE user_id = :user_id ORDER BY created_at DESC LIMIT 1"
-            ),
-            {"user_id": user.id},
-        ).fetchone()
-        if row is None:
-            notification_response = AppGetNotificationResponse(retry_after_ms=30)
-            return notification_response
+def fetch_app_notification(
+    conn: Connection, user_id: str
+) -> tuple[AppGetNotificationResponseData | None, bool]:
+    """
+    ユーザーの最新のライドについて通知する内容を組み立てる。
 
-        ride: Ride = Ride.model_validate(row)
+    まだ送っていない状態があれば最も古いものを送信済みにして返し、
+    2つ目の戻り値を True にする。
+    """
+    row = conn.execute(
+        text(
+            "SELECT * FROM rides WHERE user_id = :user_id ORDER BY created_at DESC LIMIT 1"
+        ),
+        {"user_id": user_id},
+    ).fetchone()
+    if row is None:
+        return None, False
 
+    ride: Ride = Ride.model_validate(row)
+
+    row = conn.execute(
+        text(
+            "SELECT * FROM ride_statuses WHERE ride_id = :ride_id AND app_sent_at IS NULL ORDER BY created_at ASC LIMIT 1"
+        ),
+        {"ride_id": ride.id},
+    ).fetchone()
+    yet_sent_ride_status: RideStatus | None = None
+    if row is None:
+        status = ride.latest_status
+    else:
+        yet_sent_ride_status = RideStatus.model_validate(row)
+        status = yet_sent_ride_status.status
+
+    fare = calculate_discounted_fare(
+        conn,
+        user_id,
+        ride,
+        ride.pickup_latitude,
+        ride.pickup_longitude,
+        ride.destination_latitude,
+        ride.destination_longitude,
+    )
+
+    data = AppGetNotificationResponseData(
+        ride_id=ride.id,
+        pickup_coordinate=Coordinate(
+            latitude=ride.pickup_latitude, longitude=ride.pickup_longitude
+        ),
+        destination_coordinate=Coordinate(
+            latitude=ride.destination_latitude,
+            longitude=ride.destination_longitude,
+        ),
+        fare=fare,
+        status=status,
+        chair=None,
+        created_at=timestamp_millis(ride.created_at),
+        updated_at=timestamp_millis(ride.updated_at),
+    )
+
+    if ride.chair_id:
         row = conn.execute(
-            text(
-                "SELECT * FROM ride_statuses WHERE ride_id = :ride_id AND app_sent_at IS NULL ORDER BY created_at ASC LIMIT 1"
-            ),
-            {"ride_id": ride.id},
+            text("SELECT * FROM chairs WHERE id = :chair_id"),
+            {"chair_id": ride.chair_id},
         ).fetchone()
-        yet_sent_ride_status: RideStatus | None = None
         if row is None:
-            status = get_latest_ride_status(conn, ride.id)
-        else:
-            yet_sent_ride_status = RideStatus.model_validate(row)
-            status = yet_sent_ride_status.status
+            raise HTTPException(status_code=HTTPStatus.INTERNAL_SERVER_ERROR)
 
-        fare = calculate_discounted_fare(
-            conn,
-            user.id,
-            ride,
-            ride.pickup_latitude,
-            ride.pickup_longitude,
-            ride.destination_latitude,
-            ride.destination_longitude,
+        chair: Chair = Chair.model_validate(row)
+
+        stats = get_chair_stats(conn, ride.chair_id)
+
+        data.chair = AppGetNotificationResponseChair(
+            id=chair.id, name=chair.name, model=chair.model, stats=stats
         )
 
-        notification_response = AppGetNotificationResponse(
-            data=AppGetNotificationResponseData(
-                ride_id=ride.id,
-                pickup_coordinate=Coordinate(
-                    latitude=ride.pickup_latitude, longitude=ride.pickup_longitude
-                ),
-                destination_coordinate=Coordinate(
-                    latitude=ride.destination_latitude,
-                    longitude=ride.destination_longitude,
-                ),
-                fare=fare,
-                status=status,
-                chair=None,
-                created_at=timestamp_millis(ride.created_at),
-                updated_at=timestamp_millis(ride.updated_at),
+    if yet_sent_ride_status:
+        conn.execute(
+            text(
+                "UPDATE ride_statuses SET app_sent_at = CURRENT_TIMESTAMP(6) WHERE id = :yet_send_ride_status_id"
             ),
-            retry_after_ms=30,
+            {"yet_send_ride_status_id": yet_sent_ride_status.id},
         )
 
-        if ride.chair_id:
-            row = conn.execute(
-                text("SELECT * FROM chairs WHERE id = :chair_id"),
-                {"chair_id": ride.chair_id},
-            ).fetchone()
-            if row is None:
-                raise HTTPException(status_code=HTTPStatus.INTERNAL_SERVER_ERROR)
+    return data, yet_sent_ride_status is not None
 
-            chair: Chair = Chair.model_validate(row)
 
-            stats = get_chair_stats(conn, ride.chair_id)
+def _fetch_app_notification(
+    user_id: str,
+) -> tuple[AppGetNotificationResponseData | None, bool]:
+    with engine.begin() as conn:
+        return fetch_app_notification(conn, user_id)
 
-            notification_response.data.chair = AppGetNotificationResponseChair(  # type: ignore[union-attr]
-                id=chair.id, name=chair.name, model=chair.model, stats=stats
-            )
 
-        if yet_sent_ride_status:
-            conn.execute(
-                text(
-                    "UPDATE ride_statuses SET app_sent_at = CURRENT_TIMESTAMP(6) WHERE id = :yet_send_ride_status_id"
-                ),
-                {"yet_send_ride_status_id": yet_sent_ride_status.id},
-            )
+@router.get(
+    "/notification",
+    status_code=HTTPStatus.OK,
+    response_model=AppGetNotificationResponse,
+    response_model_exclude_none=True,
+)
+def app_get_notification(
+    user: Annotated[User, Depends(app_auth_middleware)],
+    request: Request,
+) -> AppGetNotificationResponse | StreamingResponse:
+    if accepts_event_stream(request):
+        return StreamingResponse(
+            stream(user_notifications, user.id, _fetch_app_notification),
+            media_type="text/event-stream",
+        )
 
-    return notification_response
+    with engine.begin() as conn:
+        data, _ = fetch_app_notification(conn, user.id)
+    return AppGetNotificationResponse(data=data, retry_after_ms=30)
 
 
 class RecentRide(BaseModel):
@@ -691,40 +722,15 @@ class RecentRide(BaseModel):
 def get_chair_stats(
     conn: Connection, chair_id: str
 ) -> AppGetNotificationResponseChairStats:
-    rides = conn.execute(
-        text("SELECT * FROM rides WHERE chair_id = :chair_id ORDER BY updated_at DESC"),
+    # 評価と同時に COMPLETED を書き込むときに chair_stats を積み上げている
+    row = conn.execute(
+        text(
+            "SELECT total_rides_count, total_evaluation FROM chair_stats WHERE chair_id = :chair_id"
+        ),
         {"chair_id": chair_id},
-    ).fetchall()
-    total_ride_count = 0
-    total_evaluation = 0.0
-
-    for ride in rides:
-        rows = conn.execute(
-            text(
-                "SELECT * FROM ride_statuses WHERE ride_id = :ride_id ORDER BY created_at"
-            ),
-            {"ride_id": ride.id},
-        )
-        ride_statuses = [RideStatus.model_validate(row) for row in rows]
-
-        arrived_at = None
-        pickuped_at = None
-        is_completed = None
-        for status in ride_statuses:
-            if status.status == "ARRIVED":
-                arrived_at = status.created_at
-            elif status.status == "CARRYING":
-                pickuped_at = status.created_at
-            if status.status == "COMPLETED":
-                is_completed = True
-
-        if (arrived_at is None) or (pickuped_at is None):
-            continue
-        if not is_completed:
-            continue
-
-        total_ride_count += 1
-        total_evaluation += float(ride.evaluation)
+    ).fetchone()
+    total_ride_count = row.total_rides_count if row else 0
+    total_evaluation = row.total_evaluation if row else 0
 
     if total_ride_count > 0:
         total_evaluation_avg = total_evaluation / total_ride_count
@@ -758,72 +764,25 @@ def app_get_nearby_chairs(
     longitude: int,
     distance: int = 50,
 ) -> AppGetNearByChairsResponse:
-    coordinate = Coordinate(latitude=latitude, longitude=longitude)
     with engine.begin() as conn:
-        chairs = conn.execute(
-            text("SELECT * FROM chairs"),
-        ).fetchall()
-
-        near_by_chairs = []
-        for chair in chairs:
-            if not chair.is_active:
-                continue
-
-            rows = conn.execute(
-                text(
-                    "SELECT * FROM rides WHERE chair_id = :chair_id ORDER BY created_at DESC"
-                ),
-                {"chair_id": chair.id},
-            ).fetchall()
-            rides = [Ride.model_validate(row) for row in rows]
-
-            skip = False
-
-            for ride in rides:
-                # 過去にライドが存在し、かつ、それが完了していない場合はスキップ
-                status = get_latest_ride_status(conn, ride.id)
-                if status != "COMPLETED":
-                    skip = True
-                    break
-
-            if skip:
-                continue
-
-            # 最新の位置情報を取得
-            row = conn.execute(
-                text(
-                    "SELECT * FROM chair_locations WHERE chair_id = :chair_id ORDER BY created_at DESC LIMIT 1"
-                ),
-                {"chair_id": chair.id},
-            ).fetchone()
-            if row is None:
-                continue
-
-            chair_location = ChairLocation.model_validate(row)
-
-            if (
-                calculate_distance(
-                    coordinate.latitude,
-                    coordinate.longitude,
-                    chair_location.latitude,
-                    chair_location.longitude,
-                )
-                <= distance
-            ):
-                near_by_chairs.append(
-                    AppGetNearbyChairsResponseChair(
-                        id=chair.id,
-                        name=chair.name,
-                        model=chair.model,
-                        current_coordinate=Coordinate(
-                            latitude=chair_location.latitude,
-                            longitude=chair_location.longitude,
-                        ),
-                    )
-                )
+        chair_index.refresh(conn)
         retrieved_at = conn.execute(text("SELECT CURRENT_TIMESTAMP(6)")).scalar()
         assert retrieved_at is not None
 
+    # 空いている椅子だけがインデックスのセルに入っているので、椅子ごとのクエリは不要
+    near_by_chairs = [
+        AppGetNearbyChairsResponseChair(
+            id=chair.id,
+            name=chair.name,
+            model=chair.model,
+            current_coordinate=Coordinate(
+                latitude=chair.latitude,  # type: ignore[arg-type]
+                longitude=chair.longitude,  # type: ignore[arg-type]
+            ),
+        )
+        for chair in chair_index.within(latitude, longitude, distance)
+    ]
+
     return AppGetNearByChairsResponse(
         chairs=near_by_chairs,
         retrieved_at=timestamp_millis(retrieved_at),
@@ -848,32 +807,25 @@ def calculate_discounted_fare(
         pickup_longitude = ride.pickup_longitude
 
         # すでにクーポンが紐づいているならそれの割引額を参照
-        coupon = conn.execute(
-            text("SELECT * FROM coupons WHERE used_by = :ride_id"), {"ride_id": ride.id}
-        ).fetchone()
+        discount = coupon_ledger.ride_discount(conn, ride.id)
+    else:
+        # 初回利用クーポンを最優先で、無いなら他のクーポンを付与された順番に使う
+        coupon = coupon_ledger.next_coupon(conn, user_id)
         if coupon:
             discount = coupon.discount
-    else:
-        # 初回利用クーポンを最優先で使う
-        coupon = conn.execute(
-            text(
-                "SELECT * FROM coupons WHERE user_id = :user_id AND code = 'CP_NEW2024' AND used_by IS NULL"
-            ),
-            {"user_id": user_id},
-        ).fetchone()
 
-        if coupon is None:
-            # 無いなら他のクーポンを付与された順番に使う
-            coupon = conn.execute(
-                text(
-                    "SELECT * FROM coupons WHERE user_id = :user_id AND used_by IS NULL ORDER BY created_at LIMIT 1"
-                ),
-                {"user_id": user_id},
-            ).fetchone()
+    return discounted_fare(
+        pickup_latitude, pickup_longitude, dest_latitude, dest_longitude, discount
+    )
 
-        if coupon:
-            discount = coupon.discount
 
+def discounted_fare(
+    pickup_latitude: int,
+    pickup_longitude: int,
+    dest_latitude: int,
+    dest_longitude: int,
+    discount: int,
+) -> int:
     metered_fare = FARE_PER_DISTANCE * calculate_distance(
         dest_latitude, dest_longitude, pickup_latitude, pickup_longitude
     )
@@ -0,0 +1,87 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Protocol
+
+from .event_bus import event_bus
+from .models import Chair, Owner, User
+
+# 種類ごとにキャッシュするアクセストークンの最大数
+AUTH_CACHE_SIZE = int(os.getenv("ISUCON_AUTH_CACHE_SIZE", "100000"))
+
+# キャッシュしたアクセストークンを読み直すまでの秒数
+AUTH_CACHE_TTL_SEC = float(os.getenv("ISUCON_AUTH_CACHE_TTL_SEC", "300"))
+
+
+class Principal(Protocol):
+    id: str
+
+
+class PrincipalCache[T: Principal]:
+    """
+    アクセストークンから認証したユーザー・オーナー・椅子への、件数上限と有効期限つきのLRUキャッシュ。
+
+    アクセストークンは発行後に変わらないので、行の内容が変わる場合だけ
+    invalidate() で ID を指定して捨てる。
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, tuple[float, T]] = OrderedDict()
+        self._tokens_by_id: dict[str, str] = {}
+
+    def get(self, token: str) -> T | None:
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            expires_at, principal = entry
+            if expires_at < time.monotonic():
+                self._pop(token)
+                return None
+            self._entries.move_to_end(token)
+            return principal
+
+    def put(self, token: str, principal: T) -> None:
+        with self._lock:
+            self._entries[token] = (time.monotonic() + self._ttl, principal)
+            self._entries.move_to_end(token)
+            self._tokens_by_id[principal.id] = token
+            while len(self._entries) > self._maxsize:
+                self._pop(next(iter(self._entries)))
+
+    def invalidate(self, principal_id: str) -> None:
+        with self._lock:
+            token = self._tokens_by_id.get(principal_id)
+            if token is not None:
+                self._pop(token)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._tokens_by_id.clear()
+
+    def _pop(self, token: str) -> None:
+        entry = self._entries.pop(token, None)
+        if entry is not None:
+            self._tokens_by_id.pop(entry[1].id, None)
+
+
+user_cache = PrincipalCache[User](AUTH_CACHE_SIZE, AUTH_CACHE_TTL_SEC)
+owner_cache = PrincipalCache[Owner](AUTH_CACHE_SIZE, AUTH_CACHE_TTL_SEC)
+chair_cache = PrincipalCache[Chair](AUTH_CACHE_SIZE, AUTH_CACHE_TTL_SEC)
+
+
+def _on_chair_active(chair_id: str, is_active: bool) -> None:
+    chair_cache.invalidate(chair_id)
+
+
+# 椅子の稼働状態はどのワーカーで変わっても、次の認証でDBから読み直させる
+event_bus.subscribe("chair_active", _on_chair_active)
+# 初期化で作り直されたテーブルに無いトークンを通さないようにする
+event_bus.subscribe("initialize", user_cache.clear)
+event_bus.subscribe("initialize", owner_cache.clear)
+event_bus.subscribe("initialize", chair_cache.clear)
@@ -0,0 +1,33 @@
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+# chair_availability.ride_id が NULL の椅子は空いている。
+# マッチングで割り当てたライドを入れ、そのライドの COMPLETED を椅子に
+# 通知できた時点で NULL に戻す。プロセス内のミラーは chair_index の is_free。
+
+
+def register_chair(conn: Connection, chair_id: str) -> None:
+    conn.execute(
+        text("INSERT INTO chair_availability (chair_id) VALUES (:chair_id)"),
+        {"chair_id": chair_id},
+    )
+
+
+def claim_chair(conn: Connection, chair_id: str, ride_id: str) -> bool:
+    """椅子が空いていればライドを割り当てる。既に使用中なら False を返す。"""
+    result = conn.execute(
+        text(
+            "UPDATE chair_availability SET ride_id = :ride_id WHERE chair_id = :chair_id AND ride_id IS NULL"
+        ),
+        {"chair_id": chair_id, "ride_id": ride_id},
+    )
+    return result.rowcount == 1
+
+
+def release_chair(conn: Connection, chair_id: str, ride_id: str) -> None:
+    conn.execute(
+        text(
+            "UPDATE chair_availability SET ride_id = NULL WHERE chair_id = :chair_id AND ride_id = :ride_id"
+        ),
+        {"chair_id": chair_id, "ride_id": ride_id},
+    )
@@ -1,15 +1,26 @@
 from http import HTTPStatus
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, HTTPException, Response
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from sqlalchemy import text
 from ulid import ULID
 
-from .app_handlers import get_latest_ride_status
+from .app_handlers import append_ride_status
+from .chair_availability import register_chair, release_chair
+from .event_bus import event_bus
+from .location_ingest import location_ingestor
 from .middlewares import chair_auth_middleware
-from .models import Chair, ChairLocation, Owner, Ride, RideStatus, User
+from .models import Chair, Owner, Ride, RideStatus, User
+from .notifications import (
+    accepts_event_stream,
+    chair_notifications,
+    stream,
+    user_notifications,
+)
 from .sql import engine
+from .token_table import token_table
 from .utils import secure_random_str, timestamp_millis
 
 router = APIRouter(prefix="/api/chair")
@@ -67,6 +78,15 @@ def chair_post_chairs(
                 "access_token": access_token,
             },
         )
+        register_chair(conn, chair_id)
+
+        row = conn.execute(
+            text("SELECT * FROM chairs WHERE id = :id"), {"id": chair_id}
+        ).fetchone()
+        chair = Chair.model_validate(row)
+
+    token_table.put(access_token, chair)
+    event_bus.publish("chair_registered", chair.id, chair.name, chair.model, False)
 
     resp.set_cookie(path="/", key="chair_session", value=access_token)
     return ChairPostChairsResponse(id=chair_id, owner_id=owner.id)
@@ -86,6 +106,10 @@ def chair_post_activity(
             text("UPDATE chairs SET is_active = :is_active WHERE id = :id"),
             {"is_active": req.is_active, "id": chair.id},
         )
+    token_table.put(
+        chair.access_token, chair.model_copy(update={"is_active": req.is_active})
+    )
+    event_bus.publish("chair_active", chair.id, req.is_active)
 
 
 class Coordinate(BaseModel):
@@ -102,65 +126,8 @@ def chair_post_coordinate(
     chair: Annotated[Chair, Depends(chair_auth_middleware)],
     req: Coordinate,
 ) -> ChairPostCoordinateResponse:
-    with engine.begin() as conn:
-        chair_location_id = str(ULID())
-        conn.execute(
-            text(
-                "INSERT INTO chair_locations (id, chair_id, latitude, longitude) VALUES (:id, :chair_id, :latitude, :longitude)"
-            ),
-            {
-                "id": chair_location_id,
-                "chair_id": chair.id,
-                "latitude": req.latitude,
-                "longitude": req.longitude,
-            },
-        )
-
-        row = conn.execute(
-            text("SELECT * FROM chair_locations WHERE id = :id"),
-            {"id": chair_location_id},
-        ).fetchone()
-        if row is None:
-            raise HTTPException(status_code=HTTPStatus.INTERNAL_SERVER_ERROR)
-        location = ChairLocation.model_validate(row)
-
-        row = conn.execute(
-            text(
-                "SELECT * FROM rides WHERE chair_id = :chair_id ORDER BY updated_at DESC LIMIT 1"
-            ),
-            {"chair_id": chair.id},
-        ).fetchone()
-        if row is not None:
-            ride = Ride.model_validate(row)
-            ride_status = get_latest_ride_status(conn, ride_id=ride.id)
-            if ride_status != "COMPLETED" and ride_status != "CANCELLED":
-                if (
-                    req.latitude == ride.pickup_latitude
-                    and req.longitude == ride.pickup_longitude
-                    and ride_status == "ENROUTE"
-                ):
-                    conn.execute(
-                        text(
-                            "INSERT INTO ride_statuses (id, ride_id, status) VALUES (:id, :ride_id, :status)"
-                        ),
-                        {"id": str(ULID()), "ride_id": ride.id, "status": "PICKUP"},
-                    )
-
-                if (
-                    req.latitude == ride.destination_latitude
-                    and req.longitude == ride.destination_longitude
-                    and ride_status == "CARRYING"
-                ):
-                    conn.execute(
-                        text(
-                            "INSERT INTO ride_statuses (id, ride_id, status) VALUES (:id, :ride_id, :status) "
-                        ),
-                        {"id": str(ULID()), "ride_id": ride.id, "status": "ARRIVED"},
-                    )
-
-    return ChairPostCoordinateResponse(
-        recorded_at=timestamp_millis(location.created_at)
-    )
+    recorded_at = location_ingestor.record(chair.id, req.latitude, req.longitude)
+    return ChairPostCoordinateResponse(recorded_at=timestamp_millis(recorded_at))
 
 
 class SimpleUser(BaseModel):
@@ -181,21 +148,26 @@ class ChairGetNotificationResponse(BaseModel):
     retry_after_ms: int | None = None
 
 
-@router.get("/notification", response_model_exclude_none=True)
-def chair_get_notification(
-    chair: Annotated[Chair, Depends(chair_auth_middleware)],
-) -> ChairGetNotificationResponse:
+def fetch_chair_notification(
+    chair_id: str,
+) -> tuple[ChairGetNotificationResponseData | None, bool]:
+    """
+    椅子に割り当てられた最新のライドについて通知する内容を組み立てる。
+
+    まだ送っていない状態があれば最も古いものを送信済みにして返し、
+    2つ目の戻り値を True にする。完了を送った椅子は次のライドに割り当てられる。
+    """
     with engine.begin() as conn:
         ride_status = ""
         row = conn.execute(
             text(
                 "SELECT * FROM rides WHERE chair_id = :chair_id ORDER BY updated_at DESC LIMIT 1"
             ),
-            {"chair_id": chair.id},
+            {"chair_id": chair_id},
         ).fetchone()
 
         if row is None:
-            return ChairGetNotificationResponse(data=None, retry_after_ms=30)
+            return None, False
 
         ride = Ride.model_validate(row)
         yet_sent_ride_status: RideStatus | None = None
@@ -207,7 +179,7 @@ def chair_get_notification(
         ).fetchone()
 
         if row is None:
-            ride_status = get_latest_ride_status(conn, ride.id)
+            ride_status = ride.latest_status
         else:
             yet_sent_ride_status = RideStatus.model_validate(row)
             assert yet_sent_ride_status is not None
@@ -227,21 +199,44 @@ def chair_get_notification(
                 ),
                 {"id": yet_sent_ride_status.id},
             )
-
-    return ChairGetNotificationResponse(
-        data=ChairGetNotificationResponseData(
-            ride_id=ride.id,
-            user=SimpleUser(id=user.id, name=f"{user.firstname} {user.lastname}"),
-            pickup_coordinate=Coordinate(
-                latitude=ride.pickup_latitude, longitude=ride.pickup_longitude
-            ),
-            destination_coordinate=Coordinate(
-                latitude=ride.destination_latitude, longitude=ride.destination_longitude
-            ),
-            status=ride_status,
+            if yet_sent_ride_status.status == "COMPLETED":
+                release_chair(conn, chair_id, ride.id)
+
+    if yet_sent_ride_status and yet_sent_ride_status.status == "COMPLETED":
+        # 完了を椅子に通知できたので、次のライドに割り当てられる
+        event_bus.publish("chair_free", chair_id, True)
+
+    data = ChairGetNotificationResponseData(
+        ride_id=ride.id,
+        user=SimpleUser(id=user.id, name=f"{user.firstname} {user.lastname}"),
+        pickup_coordinate=Coordinate(
+            latitude=ride.pickup_latitude, longitude=ride.pickup_longitude
+        ),
+        destination_coordinate=Coordinate(
+            latitude=ride.destination_latitude, longitude=ride.destination_longitude
         ),
-        retry_after_ms=30,
+        status=ride_status,
     )
+    return data, yet_sent_ride_status is not None
+
+
+@router.get(
+    "/notification",
+    response_model=ChairGetNotificationResponse,
+    response_model_exclude_none=True,
+)
+def chair_get_notification(
+    chair: Annotated[Chair, Depends(chair_auth_middleware)],
+    request: Request,
+) -> ChairGetNotificationResponse | StreamingResponse:
+    if accepts_event_stream(request):
+        return StreamingResponse(
+            stream(chair_notifications, chair.id, fetch_chair_notification),
+            media_type="text/event-stream",
+        )
+
+    data, _ = fetch_chair_notification(chair.id)
+    return ChairGetNotificationResponse(data=data, retry_after_ms=30)
 
 
 class PostChairRidesRideIDStatusRequest(BaseModel):
@@ -272,27 +267,19 @@ def chair_post_ride_status(
         match req.status:
             # Acknowledge the ride
             case "ENROUTE":
-                conn.execute(
-                    text(
-                        "INSERT INTO ride_statuses (id, ride_id, status) VALUES (:id, :ride_id, :status)"
-                    ),
-                    {"id": str(ULID()), "ride_id": ride.id, "status": "ENROUTE"},
-                )
+                append_ride_status(conn, ride.id, "ENROUTE")
             # After Picking up user
             case "CARRYING":
-                ride_status = get_latest_ride_status(conn, ride.id)
-                if ride_status != "PICKUP":
+                if ride.latest_status != "PICKUP":
                     raise HTTPException(
                         status_code=HTTPStatus.BAD_REQUEST,
                         detail="chair has not arrived yet",
                     )
-                conn.execute(
-                    text(
-                        "INSERT INTO ride_statuses (id, ride_id, status) VALUES (:id, :ride_id, :status)"
-                    ),
-                    {"id": str(ULID()), "ride_id": ride.id, "status": "CARRYING"},
-                )
+                append_ride_status(conn, ride.id, "CARRYING")
             case _:
                 raise HTTPException(
                     status_code=HTTPStatus.BAD_REQUEST, detail="invalid status"
                 )
+
+    user_notifications.publish(ride.user_id)
+    chair_notifications.publish(chair.id)
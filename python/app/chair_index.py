@@ -0,0 +1,379 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections.abc import Iterator
+from dataclasses import dataclass, replace
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from .chair_snapshot import ChairArraySnapshot, np
+from .event_bus import event_bus
+from .utils import EPOCH, calculate_distance
+
+# グリッドの1セルあたりの幅(緯度・経度とも同じ)
+CELL_SIZE = 20
+
+# 他のワーカーが書き込んだ行のコミット遅延を吸収するための重なり幅
+SYNC_OVERLAP = timedelta(seconds=1)
+
+# refresh() でDBとの差分を取り込む最短の間隔。その間の変更はイベントバスで届く
+INDEX_REFRESH_INTERVAL_MS = int(os.getenv("ISUCON_INDEX_REFRESH_INTERVAL_MS", "1000"))
+
+# within() でこのセル数分以上の半径を指定されたら、セルを走査せず配列スナップショットで絞り込む
+WIDE_RADIUS_CELLS = 5
+
+
+@dataclass(slots=True)
+class IndexedChair:
+    id: str
+    name: str = ""
+    model: str = ""
+    is_active: bool = False
+    is_free: bool = True
+    latitude: int | None = None
+    longitude: int | None = None
+    located_at: datetime = EPOCH
+
+
+def _ring_cells(center: tuple[int, int], ring: int) -> Iterator[tuple[int, int]]:
+    # 中心セルからチェビシェフ距離がちょうど ring のセルを列挙する
+    clat, clon = center
+    if ring == 0:
+        yield center
+        return
+    for dlat in range(-ring, ring + 1):
+        yield clat + dlat, clon - ring
+        yield clat + dlat, clon + ring
+    for dlon in range(-ring + 1, ring):
+        yield clat - ring, clon + dlon
+        yield clat + ring, clon + dlon
+
+
+class ChairGridIndex:
+    """
+    空いている椅子を最新の座標で一様グリッドに振り分けて保持するプロセス内インデックス。
+
+    空いていない椅子も含め、全椅子の最新の座標のキャッシュも兼ねる。
+
+    ハンドラやイベントバスからの通知で即座に更新しつつ、イベントの取りこぼしに
+    備えて refresh() で一定間隔ごとにDBとの差分を取り込む。
+    """
+
+    def __init__(
+        self,
+        cell_size: int = CELL_SIZE,
+        refresh_interval_ms: int = INDEX_REFRESH_INTERVAL_MS,
+    ) -> None:
+        self.cell_size = cell_size
+        self._refresh_interval = refresh_interval_ms / 1000
+        self._refreshed_at = float("-inf")
+        self._lock = threading.Lock()
+        self._chairs: dict[str, IndexedChair] = {}
+        self._cells: dict[tuple[int, int], dict[str, IndexedChair]] = {}
+        self._min_cell = (0, 0)
+        self._max_cell = (0, 0)
+        self._snapshot = ChairArraySnapshot() if np is not None else None
+        self._generation: str | None = None
+        self._chairs_synced_at = EPOCH
+        self._locations_synced_at = EPOCH
+        self._availability_synced_at = EPOCH
+
+    def reset(self) -> None:
+        with self._lock:
+            self._chairs = {}
+            self._cells = {}
+            self._min_cell = (0, 0)
+            self._max_cell = (0, 0)
+            self._snapshot = ChairArraySnapshot() if np is not None else None
+            self._generation = None
+            self._chairs_synced_at = EPOCH
+            self._locations_synced_at = EPOCH
+            self._availability_synced_at = EPOCH
+            self._refreshed_at = float("-inf")
+
+    def _cell_of(self, latitude: int, longitude: int) -> tuple[int, int]:
+        return latitude // self.cell_size, longitude // self.cell_size
+
+    def _get_or_create(self, chair_id: str) -> IndexedChair:
+        chair = self._chairs.get(chair_id)
+        if chair is None:
+            chair = IndexedChair(id=chair_id)
+            self._chairs[chair_id] = chair
+        return chair
+
+    def _unlink(self, chair: IndexedChair) -> None:
+        if chair.latitude is None or chair.longitude is None:
+            return
+        cell = self._cells.get(self._cell_of(chair.latitude, chair.longitude))
+        if cell is not None:
+            cell.pop(chair.id, None)
+
+    def _link(self, chair: IndexedChair) -> None:
+        if self._snapshot is not None:
+            self._snapshot.update(
+                chair.id,
+                chair.latitude,
+                chair.longitude,
+                chair.is_active and chair.is_free,
+            )
+        if chair.latitude is None or chair.longitude is None:
+            return
+        if not (chair.is_active and chair.is_free):
+            return
+        key = self._cell_of(chair.latitude, chair.longitude)
+        self._cells.setdefault(key, {})[chair.id] = chair
+        self._min_cell = (
+            min(self._min_cell[0], key[0]),
+            min(self._min_cell[1], key[1]),
+        )
+        self._max_cell = (
+            max(self._max_cell[0], key[0]),
+            max(self._max_cell[1], key[1]),
+        )
+
+    def _update_location(
+        self, chair_id: str, latitude: int, longitude: int, located_at: datetime
+    ) -> None:
+        chair = self._get_or_create(chair_id)
+        if located_at < chair.located_at:
+            return
+        self._unlink(chair)
+        chair.latitude = latitude
+        chair.longitude = longitude
+        chair.located_at = located_at
+        self._link(chair)
+
+    def update_location(
+        self, chair_id: str, latitude: int, longitude: int, located_at: datetime
+    ) -> None:
+        with self._lock:
+            self._update_location(chair_id, latitude, longitude, located_at)
+
+    def _upsert_chair(
+        self, chair_id: str, name: str, model: str, is_active: bool
+    ) -> None:
+        chair = self._get_or_create(chair_id)
+        self._unlink(chair)
+        chair.name = name
+        chair.model = model
+        chair.is_active = is_active
+        self._link(chair)
+
+    def upsert_chair(
+        self, chair_id: str, name: str, model: str, is_active: bool
+    ) -> None:
+        with self._lock:
+            self._upsert_chair(chair_id, name, model, is_active)
+
+    def set_active(self, chair_id: str, is_active: bool) -> None:
+        with self._lock:
+            chair = self._get_or_create(chair_id)
+            self._unlink(chair)
+            chair.is_active = is_active
+            self._link(chair)
+
+    def set_free(self, chair_id: str, is_free: bool) -> None:
+        with self._lock:
+            chair = self._get_or_create(chair_id)
+            self._unlink(chair)
+            chair.is_free = is_free
+            self._link(chair)
+
+    def free_count(self) -> int:
+        with self._lock:
+            return sum(len(cell) for cell in self._cells.values())
+
+    def within(
+        self, latitude: int, longitude: int, distance: int
+    ) -> list[IndexedChair]:
+        """
+        指定座標からマンハッタン距離 distance 以内にいる空いている椅子を返す。
+
+        距離 distance のひし形と重なるセルだけを走査する。返す要素は
+        呼び出し後の更新の影響を受けないようにコピーしたもの。
+        """
+        cs = self.cell_size
+        found: list[IndexedChair] = []
+        with self._lock:
+            if self._snapshot is not None and distance >= WIDE_RADIUS_CELLS * cs:
+                # 半径が広いとセルの数が増えるので、全椅子の配列をまとめて距離で絞り込む
+                for chair_id in self._snapshot.within(latitude, longitude, distance):
+                    found.append(replace(self._chairs[chair_id]))
+                found.sort(key=lambda chair: chair.id)
+                return found
+            for row in range(
+                (latitude - distance) // cs, (latitude + distance) // cs + 1
+            ):
+                # このセル行の中で最も近い緯度までの差
+                dlat = max(row * cs - latitude, latitude - (row * cs + cs - 1), 0)
+                budget = distance - dlat
+                if budget < 0:
+                    continue
+                for col in range(
+                    (longitude - budget) // cs, (longitude + budget) // cs + 1
+                ):
+                    for chair in self._cells.get((row, col), {}).values():
+                        assert chair.latitude is not None
+                        assert chair.longitude is not None
+                        if (
+                            calculate_distance(
+                                latitude, longitude, chair.latitude, chair.longitude
+                            )
+                            <= distance
+                        ):
+                            found.append(replace(chair))
+        found.sort(key=lambda chair: chair.id)
+        return found
+
+    def iter_nearest(
+        self, latitude: int, longitude: int
+    ) -> Iterator[tuple[int, IndexedChair]]:
+        """
+        指定座標からマンハッタン距離が近い順に、空いている椅子を列挙する。
+
+        NumPy があれば配列スナップショットで全椅子の距離をまとめて求めて並べる。
+        無ければ中心セルから外側へリング単位でセルを走査し、次のリングに含まれうる
+        最小距離以下になった候補から順に返す。
+        """
+        if self._snapshot is not None:
+            with self._lock:
+                ranked = self._snapshot.ranked(latitude, longitude)
+            for distance, chair_id in ranked:
+                chair = self._chairs.get(chair_id)
+                if chair is not None and chair.is_active and chair.is_free:
+                    yield distance, chair
+            return
+
+        center = self._cell_of(latitude, longitude)
+        with self._lock:
+            max_ring = max(
+                abs(center[0] - self._min_cell[0]),
+                abs(center[0] - self._max_cell[0]),
+                abs(center[1] - self._min_cell[1]),
+                abs(center[1] - self._max_cell[1]),
+            )
+
+        heap: list[tuple[int, str, IndexedChair]] = []
+        ring = 0
+        while ring <= max_ring or heap:
+            if ring <= max_ring:
+                with self._lock:
+                    for key in _ring_cells(center, ring):
+                        for chair in self._cells.get(key, {}).values():
+                            assert chair.latitude is not None
+                            assert chair.longitude is not None
+                            distance = calculate_distance(
+                                latitude, longitude, chair.latitude, chair.longitude
+                            )
+                            heapq.heappush(heap, (distance, chair.id, chair))
+                # 次のリングの椅子は少なくともこの距離より遠い
+                bound = ring * self.cell_size
+            else:
+                bound = -1
+            while heap and (bound < 0 or heap[0][0] <= bound):
+                distance, _, chair = heapq.heappop(heap)
+                if chair.is_active and chair.is_free:
+                    yield distance, chair
+            ring += 1
+
+    def nearest(
+        self, latitude: int, longitude: int, k: int
+    ) -> list[tuple[int, IndexedChair]]:
+        """指定座標からマンハッタン距離が近い順に、空いている椅子を最大k台返す。"""
+        with self._lock:
+            if self._snapshot is not None:
+                return [
+                    (distance, self._chairs[chair_id])
+                    for distance, chair_id in self._snapshot.nearest(
+                        latitude, longitude, k
+                    )
+                ]
+        return list(itertools.islice(self.iter_nearest(latitude, longitude), k))
+
+    def refresh(self, conn: Connection) -> None:
+        """
+        他のワーカーによる椅子・位置情報・空き状況の変更をDBから取り込む。
+
+        リクエストやマッチングのたびに呼ばれるが、前回から INDEX_REFRESH_INTERVAL_MS
+        経っていなければ何もしない。
+        """
+        now = time.monotonic()
+        with self._lock:
+            if now - self._refreshed_at < self._refresh_interval:
+                return
+            self._refreshed_at = now
+
+        generation = conn.execute(
+            text("SELECT value FROM settings WHERE name = 'cache_generation'")
+        ).scalar()
+        if generation != self._generation:
+            self.reset()
+            self._generation = generation
+
+        chairs_since = self._chairs_synced_at - SYNC_OVERLAP
+        rows = conn.execute(
+            text(
+                "SELECT id, name, model, is_active, updated_at FROM chairs WHERE updated_at > :since"
+            ),
+            {"since": chairs_since},
+        ).fetchall()
+        with self._lock:
+            for row in rows:
+                self._upsert_chair(row.id, row.name, row.model, bool(row.is_active))
+                self._chairs_synced_at = max(self._chairs_synced_at, row.updated_at)
+
+        locations_since = self._locations_synced_at - SYNC_OVERLAP
+        rows = conn.execute(
+            text(
+                "SELECT chair_id, latitude, longitude, updated_at FROM chair_latest_location WHERE updated_at > :since"
+            ),
+            {"since": locations_since},
+        ).fetchall()
+        with self._lock:
+            for row in rows:
+                self._update_location(
+                    row.chair_id, row.latitude, row.longitude, row.updated_at
+                )
+                self._locations_synced_at = max(
+                    self._locations_synced_at, row.updated_at
+                )
+
+        availability_since = self._availability_synced_at - SYNC_OVERLAP
+        rows = conn.execute(
+            text(
+                "SELECT chair_id, ride_id, updated_at FROM chair_availability WHERE updated_at > :since"
+            ),
+            {"since": availability_since},
+        ).fetchall()
+        with self._lock:
+            for row in rows:
+                chair = self._get_or_create(row.chair_id)
+                self._unlink(chair)
+                chair.is_free = row.ride_id is None
+                self._link(chair)
+                self._availability_synced_at = max(
+                    self._availability_synced_at, row.updated_at
+                )
+
+
+chair_index = ChairGridIndex()
+
+
+# 他のワーカーが受け付けた変更もイベントバスで受け取り、次の refresh() を待たずに反映する
+def _on_chair_location(
+    chair_id: str, latitude: int, longitude: int, located_at: str
+) -> None:
+    chair_index.update_location(
+        chair_id, latitude, longitude, datetime.fromisoformat(located_at)
+    )
+
+
+event_bus.subscribe("chair_location", _on_chair_location)
+event_bus.subscribe("chair_registered", chair_index.upsert_chair)
+event_bus.subscribe("chair_active", chair_index.set_active)
+event_bus.subscribe("chair_free", chair_index.set_free)
+event_bus.subscribe("initialize", chair_index.reset)
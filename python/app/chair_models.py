@@ -0,0 +1,47 @@
+import threading
+
+from sqlalchemy import text
+
+from .models import ChairModel
+from .sql import engine
+
+
+class ChairModelCache:
+    """
+    chair_models はマスタデータで実行中に変わらないので、起動時に読み込んで
+    プロセス内に保持する。
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._speeds: dict[str, int] = {}
+        self._min_speed = 1
+        self._max_speed = 1
+
+    def load(self) -> None:
+        with engine.begin() as conn:
+            rows = conn.execute(text("SELECT * FROM chair_models")).fetchall()
+        self.update([ChairModel.model_validate(row) for row in rows])
+
+    def update(self, models: list[ChairModel]) -> None:
+        with self._lock:
+            self._speeds = {model.name: model.speed for model in models}
+            if self._speeds:
+                self._min_speed = min(self._speeds.values())
+                self._max_speed = max(self._speeds.values())
+
+    def _ensure_loaded(self) -> None:
+        if not self._speeds:
+            self.load()
+
+    def speed(self, model: str) -> int:
+        # 未知のモデルは最も遅いモデルと同じ速度とみなす
+        self._ensure_loaded()
+        return self._speeds.get(model, self._min_speed)
+
+    def max_speed(self) -> int:
+        self._ensure_loaded()
+        return self._max_speed
+
+
+chair_model_cache = ChairModelCache()
@@ -0,0 +1,76 @@
+from datetime import datetime
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from .models import Ride
+from .utils import calculate_sale
+
+# chair_sales は椅子ごとの売上を、ライドを完了した時刻のミリ秒単位のバケットで持つ。
+# cumulative_sales はそのバケットまでの累積和で、期間の売上は両端の累積和の差で求める。
+# 売上APIの期間指定がミリ秒単位なので、バケットの幅もミリ秒にして端数を出さない。
+
+
+def _bucket(dt: datetime) -> datetime:
+    return dt.replace(microsecond=dt.microsecond // 1000 * 1000)
+
+
+def record_chair_sale(conn: Connection, ride: Ride) -> None:
+    """完了したライドの売上を積む。ride.updated_at は評価を書き込んだ後の値であること。"""
+    assert ride.chair_id is not None
+    sales = calculate_sale(ride)
+    params = {
+        "chair_id": ride.chair_id,
+        "completed_at": _bucket(ride.updated_at),
+        "sales": sales,
+    }
+    # 時計が戻った場合だけ、後ろのバケットの累積和にも足す
+    conn.execute(
+        text(
+            "UPDATE chair_sales SET cumulative_sales = cumulative_sales + :sales WHERE chair_id = :chair_id AND completed_at > :completed_at"
+        ),
+        params,
+    )
+    previous = conn.execute(
+        text(
+            "SELECT cumulative_sales FROM chair_sales WHERE chair_id = :chair_id AND completed_at < :completed_at ORDER BY completed_at DESC LIMIT 1 FOR UPDATE"
+        ),
+        params,
+    ).scalar()
+    conn.execute(
+        text(
+            "INSERT INTO chair_sales (chair_id, completed_at, sales, cumulative_sales) VALUES (:chair_id, :completed_at, :sales, :cumulative_sales) ON DUPLICATE KEY UPDATE sales = sales + VALUES(sales), cumulative_sales = cumulative_sales + VALUES(sales)"
+        ),
+        {**params, "cumulative_sales": (previous or 0) + sales},
+    )
+
+
+def get_owner_chair_sales(
+    conn: Connection, owner_id: str, since: datetime, until: datetime
+) -> list[tuple[str, str, str, int]]:
+    """オーナーの椅子ごとに、since から until のミリ秒までに完了したライドの売上を返す。"""
+    rows = conn.execute(
+        text(
+            """
+            SELECT chairs.id,
+                   chairs.name,
+                   chairs.model,
+                   IFNULL((SELECT cumulative_sales
+                           FROM chair_sales
+                           WHERE chair_id = chairs.id
+                             AND completed_at <= :until
+                           ORDER BY completed_at DESC
+                           LIMIT 1), 0) -
+                   IFNULL((SELECT cumulative_sales
+                           FROM chair_sales
+                           WHERE chair_id = chairs.id
+                             AND completed_at < :since
+                           ORDER BY completed_at DESC
+                           LIMIT 1), 0) AS sales
+            FROM chairs
+            WHERE chairs.owner_id = :owner_id
+            """
+        ),
+        {"owner_id": owner_id, "since": _bucket(since), "until": _bucket(until)},
+    ).fetchall()
+    return [(r.id, r.name, r.model, int(r.sales)) for r in rows]
@@ -0,0 +1,102 @@
+from collections.abc import Iterator
+
+try:
+    import numpy as np
+except ImportError:  # numpy が無い環境ではグリッドの走査だけで検索する
+    np = None  # type: ignore[assignment]
+
+INITIAL_CAPACITY = 1024
+
+
+class ChairArraySnapshot:
+    """
+    椅子ID・緯度・経度・空き状況を連続した NumPy 配列で持つスナップショット。
+
+    ChairGridIndex の更新のたびに該当する行だけを書き換え、広い範囲の検索や
+    上位k件の選択を配列全体へのベクトル演算で行う。
+    """
+
+    def __init__(self, capacity: int = INITIAL_CAPACITY) -> None:
+        assert np is not None
+        self.ids: list[str] = []
+        self._rows: dict[str, int] = {}
+        self.latitudes = np.zeros(capacity, dtype=np.int64)
+        self.longitudes = np.zeros(capacity, dtype=np.int64)
+        self.available = np.zeros(capacity, dtype=np.bool_)
+
+    def _grow(self) -> None:
+        capacity = len(self.latitudes) * 2
+        self.latitudes = np.resize(self.latitudes, capacity)
+        self.longitudes = np.resize(self.longitudes, capacity)
+        self.available = np.resize(self.available, capacity)
+        self.available[len(self.ids) :] = False
+
+    def update(
+        self,
+        chair_id: str,
+        latitude: int | None,
+        longitude: int | None,
+        available: bool,
+    ) -> None:
+        row = self._rows.get(chair_id)
+        if row is None:
+            if latitude is None or longitude is None:
+                return
+            row = len(self.ids)
+            if row == len(self.latitudes):
+                self._grow()
+            self.ids.append(chair_id)
+            self._rows[chair_id] = row
+        if latitude is None or longitude is None:
+            self.available[row] = False
+            return
+        self.latitudes[row] = latitude
+        self.longitudes[row] = longitude
+        self.available[row] = available
+
+    def _distances(self, latitude: int, longitude: int):  # type: ignore[no-untyped-def]
+        n = len(self.ids)
+        return np.abs(self.latitudes[:n] - latitude) + np.abs(
+            self.longitudes[:n] - longitude
+        )
+
+    def within(self, latitude: int, longitude: int, distance: int) -> list[str]:
+        distances = self._distances(latitude, longitude)
+        rows = np.flatnonzero(self.available[: len(self.ids)] & (distances <= distance))
+        return [self.ids[row] for row in rows]
+
+    def nearest(self, latitude: int, longitude: int, k: int) -> list[tuple[int, str]]:
+        """空いている椅子のうち距離が近い順に最大k件を (距離, 椅子ID) で返す。"""
+        available = self.available[: len(self.ids)]
+        candidates = np.flatnonzero(available)
+        if k <= 0 or len(candidates) == 0:
+            return []
+        distances = self._distances(latitude, longitude)[candidates]
+        if k < len(candidates):
+            # k番目と同じ距離の椅子も残し、その中からID順に選ぶ
+            kth = np.partition(distances, k - 1)[k - 1]
+            top = np.flatnonzero(distances <= kth)
+        else:
+            top = np.arange(len(candidates))
+        # 距離が同じ椅子はグリッドの走査と同じくID順にする
+        return sorted((int(distances[i]), self.ids[candidates[i]]) for i in top)[:k]
+
+    def ranked(self, latitude: int, longitude: int) -> Iterator[tuple[int, str]]:
+        """
+        空いている椅子を距離が近い順に (距離, 椅子ID) で列挙する。距離が同じ椅子はID順。
+
+        並べ替えは呼び出した時点の配列で行うので、列挙の途中で更新されても影響を受けない。
+        """
+        candidates = np.flatnonzero(self.available[: len(self.ids)])
+        distances = self._distances(latitude, longitude)[candidates]
+        order = np.argsort(distances, kind="stable")
+        return self._iter_ranked(candidates[order], distances[order])
+
+    def _iter_ranked(self, rows, distances) -> Iterator[tuple[int, str]]:  # type: ignore[no-untyped-def]
+        group: list[tuple[int, str]] = []
+        for row, distance in zip(rows.tolist(), distances.tolist(), strict=True):
+            if group and group[0][0] != distance:
+                yield from sorted(group)
+                group = []
+            group.append((distance, self.ids[row]))
+        yield from sorted(group)
@@ -0,0 +1,142 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Iterable
+from dataclasses import dataclass
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.engine import Connection
+
+from .event_bus import event_bus
+
+# 未使用クーポンの列を覚えておくユーザー数と、ライドごとの割引額を覚えておくライド数
+COUPON_LEDGER_SIZE = int(os.getenv("ISUCON_COUPON_LEDGER_SIZE", "100000"))
+
+# 他のワーカーからの無効化を取りこぼしても、この秒数で未使用クーポンの列を読み直す
+COUPON_LEDGER_TTL_SEC = float(os.getenv("ISUCON_COUPON_LEDGER_TTL_SEC", "60"))
+
+# 使う順に並べた未使用クーポン。初回利用クーポンを最優先に、残りは付与された順
+UNUSED_COUPONS_QUERY = "SELECT code, discount FROM coupons WHERE user_id = :user_id AND used_by IS NULL ORDER BY code = 'CP_NEW2024' DESC, created_at"
+
+
+@dataclass(frozen=True)
+class LedgerCoupon:
+    code: str
+    discount: int
+
+
+class CouponLedger:
+    """
+    ユーザーごとの未使用クーポンを使う順に並べた列と、ライドに使ったクーポンの割引額を持つ。
+
+    料金の見積もりや通知などの読み込みはここだけを見る。クーポンを使うのは
+    redeem() で、coupons テーブルを FOR UPDATE で読み直して決める。クーポンが
+    増えたり使われたりしたら、コミット後に changed() で全ワーカーの列を捨てさせる。
+    ライドの割引額はライドを作ったときから変わらないので、捨てずに持ち続ける。
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._queues: OrderedDict[str, tuple[float, tuple[LedgerCoupon, ...]]] = (
+            OrderedDict()
+        )
+        self._ride_discounts: OrderedDict[str, int] = OrderedDict()
+        # 無効化のたびに進める。読み込み中に無効化された列は覚えない
+        self._generation = 0
+
+    def next_coupon(self, conn: Connection, user_id: str) -> LedgerCoupon | None:
+        """次のライドで使われるクーポンを返す。"""
+        with self._lock:
+            entry = self._queues.get(user_id)
+            if entry is not None and entry[0] >= time.monotonic():
+                self._queues.move_to_end(user_id)
+                return entry[1][0] if entry[1] else None
+            generation = self._generation
+
+        queue = tuple(
+            LedgerCoupon(code=row.code, discount=row.discount)
+            for row in conn.execute(text(UNUSED_COUPONS_QUERY), {"user_id": user_id})
+        )
+        with self._lock:
+            if generation == self._generation:
+                self._queues[user_id] = (time.monotonic() + self._ttl, queue)
+                self._queues.move_to_end(user_id)
+                while len(self._queues) > self._maxsize:
+                    self._queues.popitem(last=False)
+        return queue[0] if queue else None
+
+    def redeem(self, conn: Connection, user_id: str, ride_id: str) -> int:
+        """ユーザーの次のクーポンをライドに使い、割引額を返す。"""
+        row = conn.execute(
+            text(UNUSED_COUPONS_QUERY + " LIMIT 1 FOR UPDATE"), {"user_id": user_id}
+        ).fetchone()
+        discount = 0
+        if row is not None:
+            conn.execute(
+                text(
+                    "UPDATE coupons SET used_by = :ride_id WHERE user_id = :user_id AND code = :code"
+                ),
+                {"ride_id": ride_id, "user_id": user_id, "code": row.code},
+            )
+            discount = row.discount
+        self._remember_discounts({ride_id: discount})
+        return discount
+
+    def ride_discount(self, conn: Connection, ride_id: str) -> int:
+        return self.ride_discounts(conn, [ride_id]).get(ride_id, 0)
+
+    def ride_discounts(
+        self, conn: Connection, ride_ids: Iterable[str]
+    ) -> dict[str, int]:
+        """ライドに使ったクーポンの割引額を返す。クーポンを使っていないライドは 0。"""
+        ride_ids = list(ride_ids)
+        with self._lock:
+            found = {
+                ride_id: self._ride_discounts[ride_id]
+                for ride_id in ride_ids
+                if ride_id in self._ride_discounts
+            }
+        missing = [ride_id for ride_id in ride_ids if ride_id not in found]
+        if missing:
+            loaded = dict.fromkeys(missing, 0)
+            for row in conn.execute(
+                text(
+                    "SELECT used_by, discount FROM coupons WHERE used_by IN :ride_ids"
+                ).bindparams(bindparam("ride_ids", expanding=True)),
+                {"ride_ids": missing},
+            ):
+                loaded[row.used_by] = row.discount
+            self._remember_discounts(loaded)
+            found.update(loaded)
+        return found
+
+    def changed(self, user_id: str) -> None:
+        """ユーザーのクーポンが増えたり使われたりしたことを全ワーカーに伝える。コミット後に呼ぶ。"""
+        event_bus.publish("coupons", user_id)
+
+    def invalidate(self, user_id: str) -> None:
+        with self._lock:
+            self._generation += 1
+            self._queues.pop(user_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._queues.clear()
+            self._ride_discounts.clear()
+
+    def _remember_discounts(self, discounts: dict[str, int]) -> None:
+        with self._lock:
+            self._ride_discounts.update(discounts)
+            while len(self._ride_discounts) > self._maxsize:
+                self._ride_discounts.popitem(last=False)
+
+
+coupon_ledger = CouponLedger(COUPON_LEDGER_SIZE, COUPON_LEDGER_TTL_SEC)
+
+event_bus.subscribe("coupons", coupon_ledger.invalidate)
+# 初期化で作り直されたクーポンと食い違わないようにする
+event_bus.subscribe("initialize", coupon_ledger.clear)
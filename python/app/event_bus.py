@@ -0,0 +1,144 @@
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+from collections.abc import Callable
+from typing import Any
+
+# 各ワーカーが受信用のUnixドメインソケットを作るディレクトリ
+EVENT_BUS_DIR = os.getenv("ISUCON_EVENT_BUS_DIR", "/tmp/isuride-events")
+
+# 送信先のワーカー一覧をディレクトリから読み直す間隔
+PEERS_REFRESH_INTERVAL = 1.0
+
+MAX_DATAGRAM_SIZE = 65536
+
+
+class EventBus:
+    """
+    同じホストで動く全ワーカーにイベントを配るバス。
+
+    ワーカーごとに EVENT_BUS_DIR にデータグラムソケットを作り、publish() は
+    自プロセスのハンドラを呼んでから他のワーカーのソケットへ同じイベントを送る。
+    受信側のバッファが溢れたイベントは捨てるので、受け取る側はDBを正として
+    取りこぼしに備えること。
+    """
+
+    def __init__(self, directory: str) -> None:
+        self._directory = directory
+        self._handlers: dict[str, list[Callable[..., None]]] = {}
+        self._sender: socket.socket | None = None
+        self._path: str | None = None
+        self._peers: list[str] = []
+        self._peers_loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    def subscribe(self, topic: str, handler: Callable[..., None]) -> None:
+        self._handlers.setdefault(topic, []).append(handler)
+
+    def publish(self, topic: str, *args: Any) -> None:
+        self._dispatch(topic, args)
+        sock = self._sender
+        if sock is None:
+            return
+        message = json.dumps([topic, *args]).encode()
+        for peer in self._current_peers():
+            try:
+                sock.sendto(message, peer)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # 終了したワーカーのソケットが残っている
+                self._forget_peer(peer)
+            except BlockingIOError:
+                pass
+
+    def _dispatch(self, topic: str, args: list[Any] | tuple[Any, ...]) -> None:
+        for handler in self._handlers.get(topic, ()):
+            try:
+                handler(*args)
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+
+    def _current_peers(self) -> list[str]:
+        now = time.monotonic()
+        with self._lock:
+            if now - self._peers_loaded_at >= PEERS_REFRESH_INTERVAL:
+                try:
+                    names = os.listdir(self._directory)
+                except FileNotFoundError:
+                    names = []
+                self._peers = [
+                    path
+                    for name in names
+                    if name.endswith(".sock")
+                    and (path := os.path.join(self._directory, name)) != self._path
+                ]
+                self._peers_loaded_at = now
+            return self._peers
+
+    def _forget_peer(self, peer: str) -> None:
+        with self._lock:
+            if peer in self._peers:
+                self._peers.remove(peer)
+        try:
+            os.unlink(peer)
+        except FileNotFoundError:
+            pass
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        os.makedirs(self._directory, exist_ok=True)
+        path = os.path.join(self._directory, f"{os.getpid()}.sock")
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receiver.bind(path)
+        receiver.settimeout(0.5)
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        # 受信が詰まっているワーカーへの送信でリクエストを止めない
+        sender.setblocking(False)
+        self._sender = sender
+        self._path = path
+        self._peers_loaded_at = 0.0
+        self._thread = threading.Thread(
+            target=self._run, args=(receiver, path), name="event-bus", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        sender, path = self._sender, self._path
+        self._sender = None
+        self._path = None
+        if sender is not None:
+            sender.close()
+        if path is not None:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, receiver: socket.socket, path: str) -> None:
+        with receiver:
+            while self._path == path:
+                try:
+                    data = receiver.recv(MAX_DATAGRAM_SIZE)
+                except TimeoutError:
+                    continue
+                try:
+                    topic, *args = json.loads(data)
+                    self._dispatch(topic, args)
+                except (ValueError, TypeError):
+                    # 壊れたメッセージで受信スレッドが止まると、以降のイベントを全て取りこぼす
+                    traceback.print_exc(file=sys.stderr)
+
+
+event_bus = EventBus(EVENT_BUS_DIR)
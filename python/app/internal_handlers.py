@@ -1,89 +1,48 @@
 from http import HTTPStatus
 
 from fastapi import APIRouter
-from sqlalchemy import text
+from pydantic import BaseModel
 
-from .models import Chair, Ride
-from .sql import engine
+from .matching_scheduler import MATCHING_INTERVAL_MS, matching_stats, run_matching_tick
 
 router = APIRouter(prefix="/api/internal")
 
 
 # このAPIをインスタンス内から一定間隔で叩かせることで、椅子とライドをマッチングさせる
+# (ISUCON_MATCHING_INTERVAL_MS を設定すれば各ワーカー内のスケジューラからも実行される)
 @router.get("/matching", status_code=HTTPStatus.NO_CONTENT)
 def internal_get_matching() -> None:
-    # MEMO: 最もマンハッタン距離？が近い椅子を選んでいる
-    with engine.begin() as conn:
-        row = conn.execute(
-            text(
-                "SELECT * FROM rides WHERE chair_id IS NULL ORDER BY created_at LIMIT 1"
-            )
-        ).fetchone()
-        if row is None:
-            return
-        ride = Ride.model_validate(row)
-        pickup_lat = ride.pickup_latitude
-        pickup_lon = ride.pickup_longitude
-
-        matched: Chair | None = None
-        empty = False
-
-        query = text("""
-                  SELECT c.*
-                  FROM chairs c
-                  INNER JOIN chair_locations cl ON c.id = cl.chair_id
-                  WHERE c.is_active = TRUE
-                  ORDER BY (ABS(cl.latitude - :lat) + ABS(cl.longitude - :lon)) ASC
-                  LIMIT 1
-              """)
-
-        chair_row = conn.execute(query, {"lat": pickup_lat, "lon": pickup_lon}).fetchone()
-
-        if chair_row is None:
-            return
-        matched = Chair.model_validate(chair_row)
-        
-        empty = bool(
-          conn.execute(
-              text(
-                  "SELECT COUNT(*) = 0 FROM ("
-                  "SELECT COUNT(chair_sent_at) = 6 AS completed "
-                  "FROM ride_statuses "
-                  "WHERE ride_id IN (SELECT id FROM rides WHERE chair_id = :chair_id) "
-                  "GROUP BY ride_id"
-                  ") is_completed WHERE completed = FALSE"
-              ),
-              {"chair_id": matched.id},
-          ).scalar()
-        )
-
-
-        #for _ in range(10):
-        #    row = conn.execute(
-        #        text(
-        #            "SELECT * FROM chairs INNER JOIN (SELECT id FROM chairs WHERE is_active = TRUE ORDER BY RAND() LIMIT 1) AS tmp ON chairs.id = tmp.id LIMIT 1"
-        #        )
-        #    ).fetchone()
-        #    if row is None:
-        #        return
-        #    matched = Chair.model_validate(row)
-
-        #    empty = bool(
-        #        conn.execute(
-        #            text(
-        #                "SELECT COUNT(*) = 0 FROM (SELECT COUNT(chair_sent_at) = 6 AS completed FROM ride_statuses WHERE ride_id IN (SELECT id FROM rides WHERE chair_id = :chair_id) GROUP BY ride_id) is_completed WHERE completed = FALSE"
-        #            ),
-        #            {"chair_id": matched.id},
-        #        ).scalar()
-        #    )
-        #    if empty:
-        #        break
-
-        if not empty:
-            return
-
-        assert matched is not None
-        conn.execute(
-            text("UPDATE rides SET chair_id = :chair_id WHERE id = :id"),
-            {"chair_id": matched.id, "id": ride.id},
-        )
+    # MEMO: 空いている椅子のうち、最もマンハッタン距離が近い椅子を選んでいる
+    run_matching_tick()
+
+
+class InternalGetMatchingStatsResponse(BaseModel):
+    interval_ms: int
+    ticks: int
+    skipped_ticks: int
+    matched_total: int
+    recent_ticks: int
+    avg_tick_ms: float
+    max_tick_ms: float
+    avg_matched: float
+    last_backlog: int
+
+
+# このワーカーで実行したマッチングの統計 (間隔のチューニング用)
+@router.get("/matching/stats", status_code=HTTPStatus.OK)
+def internal_get_matching_stats() -> InternalGetMatchingStatsResponse:
+    ticks, skipped_ticks, matched_total, recent = matching_stats.snapshot()
+    durations = [tick.duration_ms for tick in recent]
+    return InternalGetMatchingStatsResponse(
+        interval_ms=MATCHING_INTERVAL_MS,
+        ticks=ticks,
+        skipped_ticks=skipped_ticks,
+        matched_total=matched_total,
+        recent_ticks=len(recent),
+        avg_tick_ms=sum(durations) / len(recent) if recent else 0.0,
+        max_tick_ms=max(durations, default=0.0),
+        avg_matched=sum(tick.matched for tick in recent) / len(recent)
+        if recent
+        else 0.0,
+        last_backlog=recent[-1].backlog if recent else 0,
+    )
@@ -0,0 +1,61 @@
+from collections.abc import Callable, Iterable, Mapping
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.engine import Connection
+
+from .coupon_ledger import coupon_ledger
+from .models import Chair, Owner
+
+
+class Loader[K, V]:
+    """
+    1リクエストの間に必要になったキーを、まとめて1回の IN クエリで引くローダー。
+
+    一度引いたキーは見つからなかったものも含めて覚えておき、同じリクエストの中では
+    二度クエリを投げない。トランザクションをまたいで使い回さないこと。
+    """
+
+    def __init__(self, batch: Callable[[list[K]], Mapping[K, V]]) -> None:
+        self._batch = batch
+        self._loaded: dict[K, V | None] = {}
+
+    def load_many(self, keys: Iterable[K]) -> dict[K, V]:
+        keys = list(dict.fromkeys(keys))
+        missing = [key for key in keys if key not in self._loaded]
+        if missing:
+            found = self._batch(missing)
+            for key in missing:
+                self._loaded[key] = found.get(key)
+        return {key: value for key in keys if (value := self._loaded[key]) is not None}
+
+
+def _batch_chairs(conn: Connection, ids: list[str]) -> dict[str, Chair]:
+    rows = conn.execute(
+        text("SELECT * FROM chairs WHERE id IN :ids").bindparams(
+            bindparam("ids", expanding=True)
+        ),
+        {"ids": ids},
+    ).fetchall()
+    return {row.id: Chair.model_validate(row) for row in rows}
+
+
+def _batch_owners(conn: Connection, ids: list[str]) -> dict[str, Owner]:
+    rows = conn.execute(
+        text("SELECT * FROM owners WHERE id IN :ids").bindparams(
+            bindparam("ids", expanding=True)
+        ),
+        {"ids": ids},
+    ).fetchall()
+    return {row.id: Owner.model_validate(row) for row in rows}
+
+
+class Loaders:
+    """1リクエスト分のローダーをまとめたもの。"""
+
+    def __init__(self, conn: Connection) -> None:
+        self.chairs = Loader[str, Chair](lambda ids: _batch_chairs(conn, ids))
+        self.owners = Loader[str, Owner](lambda ids: _batch_owners(conn, ids))
+        # ライドIDから、そのライドに使ったクーポンの割引額
+        self.ride_discounts = Loader[str, int](
+            lambda ride_ids: coupon_ledger.ride_discounts(conn, ride_ids)
+        )
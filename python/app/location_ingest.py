@@ -0,0 +1,392 @@
+import itertools
+import os
+import sys
+import threading
+import traceback
+from dataclasses import dataclass
+from datetime import UTC, datetime
+from http import HTTPStatus
+
+from fastapi import HTTPException
+from sqlalchemy import bindparam, text
+from sqlalchemy.engine import Connection, Row
+from ulid import ULID
+
+from .app_handlers import append_ride_statuses
+from .event_bus import event_bus
+from .notifications import chair_notifications, user_notifications
+from .sql import engine
+from .utils import calculate_distance
+
+# バッファがこの件数に達したら待たずに書き出す
+LOCATION_FLUSH_SIZE = int(os.getenv("ISUCON_LOCATION_FLUSH_SIZE", "500"))
+
+# バッファに溜めておく最大時間。0 以下ならリクエストごとに同期して書き出す
+LOCATION_MAX_BUFFER_AGE_MS = int(os.getenv("ISUCON_LOCATION_MAX_BUFFER_AGE_MS", "100"))
+
+# 終了時にバッファに残っている位置情報を書き出すか
+LOCATION_FLUSH_ON_SHUTDOWN = os.getenv("ISUCON_LOCATION_FLUSH_ON_SHUTDOWN", "1") == "1"
+
+# この回数書き出しに失敗した位置情報は1件ずつ書き出し直し、それでも失敗したものは捨てる
+LOCATION_FLUSH_MAX_ATTEMPTS = int(os.getenv("ISUCON_LOCATION_FLUSH_MAX_ATTEMPTS", "3"))
+
+# chair_locations の latitude, longitude (INTEGER) に入る範囲
+COORDINATE_MIN = -(2**31)
+COORDINATE_MAX = 2**31 - 1
+
+
+@dataclass(slots=True)
+class BufferedLocation:
+    id: str
+    chair_id: str
+    latitude: int
+    longitude: int
+    created_at: datetime
+    attempts: int = 0
+
+
+def _path_distance(locations: list[BufferedLocation]) -> int:
+    return sum(
+        calculate_distance(a.latitude, a.longitude, b.latitude, b.longitude)
+        for a, b in itertools.pairwise(locations)
+    )
+
+
+def _late_distance(
+    conn: Connection, chair_id: str, late: list[BufferedLocation]
+) -> int:
+    """
+    書き込み済みの最新位置より古い位置情報 late を、時刻順の履歴に差し込んだときの
+    総移動距離の増分を返す。
+
+    位置情報ごとに書き込み済みの直前・直後の1件だけを引き、同じ2点の間に
+    挟まる位置情報はまとめて1本の経路として数える。
+    """
+    # 直後の位置情報ID -> (直前の位置情報, 直後の位置情報, 間に挟まる位置情報)
+    gaps: dict[str, tuple[Row | None, Row, list[BufferedLocation]]] = {}
+    for location in late:
+        params = {"chair_id": chair_id, "created_at": location.created_at}
+        following = conn.execute(
+            text(
+                "SELECT id, latitude, longitude FROM chair_locations WHERE chair_id = :chair_id AND created_at > :created_at ORDER BY created_at LIMIT 1"
+            ),
+            params,
+        ).one()
+        if following.id not in gaps:
+            preceding = conn.execute(
+                text(
+                    "SELECT id, latitude, longitude FROM chair_locations WHERE chair_id = :chair_id AND created_at <= :created_at ORDER BY created_at DESC LIMIT 1"
+                ),
+                params,
+            ).fetchone()
+            gaps[following.id] = (preceding, following, [])
+        gaps[following.id][2].append(location)
+
+    delta = 0
+    for preceding, following, between in gaps.values():
+        first, last = between[0], between[-1]
+        delta += _path_distance(between) + calculate_distance(
+            last.latitude, last.longitude, following.latitude, following.longitude
+        )
+        if preceding is not None:
+            delta += calculate_distance(
+                preceding.latitude, preceding.longitude, first.latitude, first.longitude
+            ) - calculate_distance(
+                preceding.latitude,
+                preceding.longitude,
+                following.latitude,
+                following.longitude,
+            )
+    return delta
+
+
+def write_locations(conn: Connection, locations: list[BufferedLocation]) -> None:
+    """
+    位置情報を chair_locations に書き込み、椅子ごとの最新位置と総移動距離を更新する。
+
+    総移動距離は前回の最新位置からの差分を足し込んでいく。他のワーカーが
+    より新しい位置情報を先に書き込んでいた場合は、それより古い位置情報ごとに
+    前後の位置情報を引き、間に挟まった分だけ総移動距離を補正する。
+    """
+    by_chair: dict[str, list[BufferedLocation]] = {}
+    for location in sorted(locations, key=lambda location: location.created_at):
+        by_chair.setdefault(location.chair_id, []).append(location)
+
+    # 同じ椅子の位置情報を書き出す他のワーカーと直列化する
+    current = {
+        row.chair_id: row
+        for row in conn.execute(
+            text(
+                "SELECT chair_id, latitude, longitude, total_distance, updated_at FROM chair_latest_location WHERE chair_id IN :chair_ids FOR UPDATE"
+            ).bindparams(bindparam("chair_ids", expanding=True)),
+            {"chair_ids": list(by_chair)},
+        ).fetchall()
+    }
+
+    latest = []
+    for chair_id, chair_locations in by_chair.items():
+        row = current.get(chair_id)
+        if row is None:
+            last = chair_locations[-1]
+            latest.append(
+                {
+                    "chair_id": chair_id,
+                    "latitude": last.latitude,
+                    "longitude": last.longitude,
+                    "total_distance": _path_distance(chair_locations),
+                    "updated_at": last.created_at,
+                }
+            )
+            continue
+
+        late = [
+            location
+            for location in chair_locations
+            if location.created_at < row.updated_at
+        ]
+        tail = chair_locations[len(late) :]
+        total_distance = row.total_distance + _late_distance(conn, chair_id, late)
+        if tail:
+            total_distance += calculate_distance(
+                row.latitude, row.longitude, tail[0].latitude, tail[0].longitude
+            ) + _path_distance(tail)
+            last = tail[-1]
+            latest.append(
+                {
+                    "chair_id": chair_id,
+                    "latitude": last.latitude,
+                    "longitude": last.longitude,
+                    "total_distance": total_distance,
+                    "updated_at": last.created_at,
+                }
+            )
+        else:
+            latest.append(
+                {
+                    "chair_id": chair_id,
+                    "latitude": row.latitude,
+                    "longitude": row.longitude,
+                    "total_distance": total_distance,
+                    "updated_at": row.updated_at,
+                }
+            )
+
+    # 前後の位置情報を引くのは書き込み済みの分だけにしたいので、補正の後に書き込む
+    conn.execute(
+        text(
+            "INSERT INTO chair_locations (id, chair_id, latitude, longitude, created_at) VALUES (:id, :chair_id, :latitude, :longitude, :created_at)"
+        ),
+        [
+            {
+                "id": location.id,
+                "chair_id": location.chair_id,
+                "latitude": location.latitude,
+                "longitude": location.longitude,
+                "created_at": location.created_at,
+            }
+            for location in locations
+        ],
+    )
+    conn.execute(
+        text(
+            "INSERT INTO chair_latest_location (chair_id, latitude, longitude, total_distance, updated_at) VALUES (:chair_id, :latitude, :longitude, :total_distance, :updated_at) ON DUPLICATE KEY UPDATE latitude = VALUES(latitude), longitude = VALUES(longitude), total_distance = VALUES(total_distance), updated_at = VALUES(updated_at)"
+        ),
+        latest,
+    )
+
+
+def _advance_ride_statuses(
+    conn: Connection, locations: list[BufferedLocation]
+) -> list[tuple[str, str]]:
+    """
+    書き出す位置情報で椅子が乗車位置・目的地に着いていれば PICKUP / ARRIVED を記録する。
+
+    各椅子の最新のライドとその状態をバッチ全体でまとめて取得してから、
+    椅子ごとに時刻順に判定する。
+    """
+    chair_ids = {location.chair_id for location in locations}
+    rides = {
+        row.chair_id: row
+        for row in conn.execute(
+            text(
+                "SELECT id, user_id, chair_id, pickup_latitude, pickup_longitude, destination_latitude, destination_longitude, latest_status FROM (SELECT *, ROW_NUMBER() OVER (PARTITION BY chair_id ORDER BY updated_at DESC) AS rn FROM rides WHERE chair_id IN :chair_ids) AS latest WHERE rn = 1"
+            ).bindparams(bindparam("chair_ids", expanding=True)),
+            {"chair_ids": list(chair_ids)},
+        ).fetchall()
+    }
+
+    statuses = {ride.id: ride.latest_status for ride in rides.values()}
+    appended: list[tuple[str, str]] = []
+    # 状態が進んだライドの (ユーザーID, 椅子ID)
+    notified: list[tuple[str, str]] = []
+    for location in locations:
+        ride = rides.get(location.chair_id)
+        if ride is None:
+            continue
+        status = statuses[ride.id]
+        at = (location.latitude, location.longitude)
+        if status == "ENROUTE" and at == (ride.pickup_latitude, ride.pickup_longitude):
+            status = "PICKUP"
+        elif status == "CARRYING" and at == (
+            ride.destination_latitude,
+            ride.destination_longitude,
+        ):
+            status = "ARRIVED"
+        else:
+            continue
+        statuses[ride.id] = status
+        appended.append((ride.id, status))
+        notified.append((ride.user_id, ride.chair_id))
+    append_ride_statuses(conn, appended)
+    return notified
+
+
+class LocationIngestor:
+    """
+    椅子の位置情報をプロセス内で時刻付けしてバッファし、まとめてDBに書き出す。
+
+    バッファが LOCATION_FLUSH_SIZE 件に達するか、最も古い位置情報が
+    LOCATION_MAX_BUFFER_AGE_MS を超えるまで溜めてから1トランザクションで書き出す。
+    各ワーカーの椅子インデックスには、書き出しをコミットした後にイベントバスから反映する。
+    """
+
+    def __init__(self, flush_size: int, max_buffer_age_ms: int) -> None:
+        self._flush_size = flush_size
+        self._max_age = max_buffer_age_ms / 1000
+        self._lock = threading.Lock()
+        # 書き出しが並行して走り、古いバッファが後から書き込まれないようにする
+        self._flush_lock = threading.Lock()
+        self._buffer: list[BufferedLocation] = []
+        self._full = threading.Event()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def record(self, chair_id: str, latitude: int, longitude: int) -> datetime:
+        # 書き出しはリクエストの後なので、DBに入らない値はここで弾く
+        if not (
+            COORDINATE_MIN <= latitude <= COORDINATE_MAX
+            and COORDINATE_MIN <= longitude <= COORDINATE_MAX
+        ):
+            raise HTTPException(
+                status_code=HTTPStatus.BAD_REQUEST, detail="coordinate out of range"
+            )
+        location = BufferedLocation(
+            id=str(ULID()),
+            chair_id=chair_id,
+            latitude=latitude,
+            longitude=longitude,
+            # DATETIME(6) に合わせてマイクロ秒精度のUTCで記録する
+            created_at=datetime.now(UTC).replace(tzinfo=None),
+        )
+        with self._lock:
+            self._buffer.append(location)
+            full = len(self._buffer) >= self._flush_size
+
+        if self._max_age <= 0:
+            self.flush()
+        elif full:
+            self._full.set()
+        return location.created_at
+
+    def flush(self) -> None:
+        with self._flush_lock:
+            with self._lock:
+                locations, self._buffer = self._buffer, []
+            if not locations:
+                return
+            exhausted = [
+                location
+                for location in locations
+                if location.attempts >= LOCATION_FLUSH_MAX_ATTEMPTS
+            ]
+            if exhausted:
+                # 何度も失敗している位置情報は、原因の行だけを捨てられるよう1件ずつ書き出す
+                locations = [
+                    location
+                    for location in locations
+                    if location.attempts < LOCATION_FLUSH_MAX_ATTEMPTS
+                ]
+                for location in exhausted:
+                    self._write_or_drop(location)
+                if not locations:
+                    return
+            try:
+                self._write(locations)
+            except Exception:
+                # 書き出せなかった分は次回の書き出しで再試行する
+                for location in locations:
+                    location.attempts += 1
+                with self._lock:
+                    self._buffer[:0] = locations
+                raise
+
+    def _write(self, locations: list[BufferedLocation]) -> None:
+        with engine.begin() as conn:
+            write_locations(conn, locations)
+            notified = _advance_ride_statuses(conn, locations)
+        # 捨てることになった位置情報がインデックスに残らないよう、書き込めた分だけ反映する。
+        # インデックスは古い位置情報を無視するので、椅子ごとに最新の1件だけ送ればよい
+        latest: dict[str, BufferedLocation] = {}
+        for location in locations:
+            current = latest.get(location.chair_id)
+            if current is None or current.created_at <= location.created_at:
+                latest[location.chair_id] = location
+        for location in latest.values():
+            event_bus.publish(
+                "chair_location",
+                location.chair_id,
+                location.latitude,
+                location.longitude,
+                location.created_at.isoformat(),
+            )
+        for user_id, chair_id in notified:
+            user_notifications.publish(user_id)
+            chair_notifications.publish(chair_id)
+
+    def _write_or_drop(self, location: BufferedLocation) -> None:
+        try:
+            self._write([location])
+        except Exception:
+            print(
+                f"dropped chair location after {location.attempts} failed flushes: {location}",
+                file=sys.stderr,
+            )
+            traceback.print_exc(file=sys.stderr)
+
+    def discard(self) -> None:
+        # /api/initialize でDBを作り直したときに、古い位置情報を書き込まないようにする
+        with self._flush_lock, self._lock:
+            self._buffer = []
+
+    def start(self) -> None:
+        if self._thread is not None or self._max_age <= 0:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="location-ingestor", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, flush: bool = LOCATION_FLUSH_ON_SHUTDOWN) -> None:
+        self._stop.set()
+        self._full.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if flush:
+            self.flush()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._full.wait(self._max_age)
+            self._full.clear()
+            if self._stop.is_set():
+                break
+            try:
+                self.flush()
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+
+
+location_ingestor = LocationIngestor(LOCATION_FLUSH_SIZE, LOCATION_MAX_BUFFER_AGE_MS)
+event_bus.subscribe("initialize", location_ingestor.discard)
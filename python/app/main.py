@@ -1,5 +1,7 @@
 import subprocess
 import sys
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
 from http import HTTPStatus
 
 from fastapi import FastAPI, HTTPException, Request
@@ -8,11 +10,34 @@ from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 from sqlalchemy import text
 from sqlalchemy.exc import SQLAlchemyError
+from ulid import ULID
 
 from . import app_handlers, chair_handlers, internal_handlers, owner_handlers
+from .chair_models import chair_model_cache
+from .event_bus import event_bus
+from .location_ingest import location_ingestor
+from .matching_scheduler import MATCHING_INTERVAL_MS, matching_scheduler
+from .payment_outbox import payment_dispatcher
 from .sql import engine
+from .token_table import token_table
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(_: FastAPI) -> AsyncIterator[None]:
+    event_bus.start()
+    chair_model_cache.load()
+    location_ingestor.start()
+    if MATCHING_INTERVAL_MS > 0:
+        matching_scheduler.start()
+    payment_dispatcher.start()
+    yield
+    payment_dispatcher.stop()
+    matching_scheduler.stop()
+    location_ingestor.stop()
+    event_bus.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 app.include_router(app_handlers.router)
 app.include_router(chair_handlers.router)
 app.include_router(internal_handlers.router)
@@ -45,6 +70,16 @@ def post_initialize(req: PostInitializeRequest) -> PostInitializeResponse:
             ),
             {"value": req.payment_server},
         )
+        # 各ワーカーのプロセス内キャッシュを作り直させる
+        conn.execute(
+            text(
+                "INSERT INTO settings (name, value) VALUES ('cache_generation', :value) ON DUPLICATE KEY UPDATE value = :value"
+            ),
+            {"value": str(ULID())},
+        )
+    # 全ワーカーのプロセス内キャッシュと書き出し待ちの位置情報を捨てさせる
+    token_table.clear()
+    event_bus.publish("initialize")
 
     return PostInitializeResponse(language="python")
 
@@ -0,0 +1,350 @@
+import heapq
+import itertools
+import os
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass
+from typing import Protocol
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from .chair_availability import claim_chair
+from .chair_index import ChairGridIndex, IndexedChair
+from .chair_models import chair_model_cache
+from .models import Ride
+from .utils import calculate_distance
+
+
+@dataclass(frozen=True, slots=True)
+class MatchingConfig:
+    # single: 1回の呼び出しで最も古いライドを1件だけ割り当てる
+    # batch: 未割り当てのライドをまとめて割り当てる
+    mode: str = "batch"
+    # 候補の順位付け
+    # distance: 迎車距離が短い順
+    # eta: 迎車距離を椅子モデルの速度で割った到着予想時間が短い順
+    strategy: str = "distance"
+    # batch モードでの割り当て方法 (greedy / min_cost)
+    solver: str = "greedy"
+    # min_cost で解く最大ライド数。これを超える場合は greedy で割り当てる
+    min_cost_max_rides: int = 100
+
+
+DEFAULT_CONFIG = MatchingConfig(
+    mode=os.getenv("ISUCON_MATCHING_MODE", "batch"),
+    strategy=os.getenv("ISUCON_MATCHING_STRATEGY", "distance"),
+    solver=os.getenv("ISUCON_MATCHING_SOLVER", "greedy"),
+    min_cost_max_rides=int(os.getenv("ISUCON_MATCHING_MIN_COST_MAX_RIDES", "100")),
+)
+
+# batch モードで、使用中だった椅子を除いて割り当て直す最大回数
+BATCH_MAX_ROUNDS = 3
+
+
+@dataclass(slots=True)
+class MatchingResult:
+    # 今回割り当てたライド数
+    matched: int = 0
+    # 割り当て前に残っていた未割り当てライド数
+    backlog: int = 0
+
+
+class MatchingSource(Protocol):
+    """マッチングが読み書きするデータの取得元。本番ではDB、シミュレータではメモリ上のもの。"""
+
+    def count_pending_rides(self) -> int: ...
+
+    def pending_rides(self, limit: int | None = None) -> list[Ride]: ...
+
+    def sync(self, index: ChairGridIndex) -> None: ...
+
+    def assign(self, ride: Ride, chair: IndexedChair) -> bool: ...
+
+
+class SqlMatchingSource:
+    def __init__(self, conn: Connection) -> None:
+        self.conn = conn
+        # コミット後に通知するため、ライドを割り当てた椅子を覚えておく
+        self.assigned_chair_ids: list[str] = []
+
+    def count_pending_rides(self) -> int:
+        count = self.conn.execute(
+            text("SELECT COUNT(*) FROM rides WHERE chair_id IS NULL")
+        ).scalar()
+        return count or 0
+
+    def pending_rides(self, limit: int | None = None) -> list[Ride]:
+        query = "SELECT * FROM rides WHERE chair_id IS NULL ORDER BY created_at"
+        params = {}
+        if limit is not None:
+            query += " LIMIT :limit"
+            params["limit"] = limit
+        rows = self.conn.execute(text(query), params).fetchall()
+        return [Ride.model_validate(row) for row in rows]
+
+    def sync(self, index: ChairGridIndex) -> None:
+        index.refresh(self.conn)
+
+    def assign(self, ride: Ride, chair: IndexedChair) -> bool:
+        if not claim_chair(self.conn, chair.id, ride.id):
+            return False
+        self.conn.execute(
+            text("UPDATE rides SET chair_id = :chair_id WHERE id = :id"),
+            {"chair_id": chair.id, "id": ride.id},
+        )
+        self.assigned_chair_ids.append(chair.id)
+        return True
+
+
+def pickup_cost(
+    chair: IndexedChair, latitude: int, longitude: int, strategy: str
+) -> float:
+    assert chair.latitude is not None
+    assert chair.longitude is not None
+    distance = calculate_distance(latitude, longitude, chair.latitude, chair.longitude)
+    if strategy == "eta":
+        return distance / chair_model_cache.speed(chair.model)
+    return distance
+
+
+def rank_by_eta(
+    index: ChairGridIndex, latitude: int, longitude: int
+) -> Iterator[tuple[float, IndexedChair]]:
+    """
+    到着予想時間(迎車距離 / 椅子モデルの速度)が短い順に空いている椅子を列挙する。
+
+    距離の近い順に候補を受け取り、最も速いモデルでもそれより早くは着けない
+    時間以下になった候補から確定させていく。
+    """
+    max_speed = chair_model_cache.max_speed()
+    heap: list[tuple[float, str, IndexedChair]] = []
+
+    def pop_until(bound: float) -> Iterator[tuple[float, IndexedChair]]:
+        while heap and heap[0][0] <= bound:
+            eta, _, chair = heapq.heappop(heap)
+            if chair.is_active and chair.is_free:
+                yield eta, chair
+
+    for distance, chair in index.iter_nearest(latitude, longitude):
+        eta = distance / chair_model_cache.speed(chair.model)
+        heapq.heappush(heap, (eta, chair.id, chair))
+        yield from pop_until(distance / max_speed)
+    yield from pop_until(float("inf"))
+
+
+def rank_candidates(
+    index: ChairGridIndex, latitude: int, longitude: int, strategy: str
+) -> Iterator[tuple[float, IndexedChair]]:
+    if strategy == "eta":
+        return rank_by_eta(index, latitude, longitude)
+    return index.iter_nearest(latitude, longitude)
+
+
+def assign_greedy(
+    rides: list[Ride], index: ChairGridIndex, config: MatchingConfig
+) -> list[tuple[Ride, IndexedChair]]:
+    """
+    全ライドと空き椅子の組のうち、迎車コストが小さいものから順に確定させていく。
+
+    各ライドの最近傍候補をヒープに積み、取り出した椅子が既に使われていれば
+    そのライドの次の候補を積み直す。
+    """
+    candidates: list[Iterator[tuple[float, IndexedChair]]] = [
+        rank_candidates(
+            index, ride.pickup_latitude, ride.pickup_longitude, config.strategy
+        )
+        for ride in rides
+    ]
+    heap: list[tuple[float, int, IndexedChair]] = []
+    for i, it in enumerate(candidates):
+        nearest = next(it, None)
+        if nearest is not None:
+            heapq.heappush(heap, (nearest[0], i, nearest[1]))
+
+    taken: set[str] = set()
+    pairs: list[tuple[Ride, IndexedChair]] = []
+    while heap:
+        _, i, chair = heapq.heappop(heap)
+        if chair.id in taken:
+            nearest = next(candidates[i], None)
+            if nearest is not None:
+                heapq.heappush(heap, (nearest[0], i, nearest[1]))
+            continue
+        taken.add(chair.id)
+        pairs.append((rides[i], chair))
+    return pairs
+
+
+def assign_min_cost(
+    rides: list[Ride], index: ChairGridIndex, config: MatchingConfig
+) -> list[tuple[Ride, IndexedChair]]:
+    """
+    迎車コストの合計が最小になる割り当てをハンガリアン法で求める。
+
+    各ライドについてコストの小さい順に len(rides) 台までの椅子だけを候補にしても
+    最適解は失われないので、その和集合に対してコスト行列を作る。
+    """
+    if len(rides) > config.min_cost_max_rides:
+        return assign_greedy(rides, index, config)
+
+    chairs: dict[str, IndexedChair] = {}
+    for ride in rides:
+        candidates: Iterator[tuple[float, IndexedChair]]
+        if config.strategy == "eta":
+            candidates = itertools.islice(
+                rank_by_eta(index, ride.pickup_latitude, ride.pickup_longitude),
+                len(rides),
+            )
+        else:
+            candidates = iter(
+                index.nearest(ride.pickup_latitude, ride.pickup_longitude, len(rides))
+            )
+        for _, chair in candidates:
+            chairs[chair.id] = chair
+    columns = list(chairs.values())
+    if len(columns) < len(rides):
+        # 空き椅子がライド数より少ないときは全組み合わせを試せないので greedy に任せる
+        return assign_greedy(rides, index, config)
+
+    cost = [
+        [
+            pickup_cost(
+                chair, ride.pickup_latitude, ride.pickup_longitude, config.strategy
+            )
+            for chair in columns
+        ]
+        for ride in rides
+    ]
+    assignment = _hungarian(cost)
+    return [(ride, columns[j]) for ride, j in zip(rides, assignment) if j >= 0]
+
+
+def _hungarian(cost: list[list[float]]) -> list[int]:
+    # 行数 <= 列数 のコスト行列に対し、各行に割り当てる列の添字を返す
+    n = len(cost)
+    m = len(cost[0])
+    inf = float("inf")
+    u = [0.0] * (n + 1)
+    v = [0.0] * (m + 1)
+    p = [0] * (m + 1)
+    way = [0] * (m + 1)
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = [inf] * (m + 1)
+        used = [False] * (m + 1)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            delta = inf
+            j1 = 0
+            row = cost[i0 - 1]
+            for j in range(1, m + 1):
+                if used[j]:
+                    continue
+                cur = row[j - 1] - u[i0] - v[j]
+                if cur < minv[j]:
+                    minv[j] = cur
+                    way[j] = j0
+                if minv[j] < delta:
+                    delta = minv[j]
+                    j1 = j
+            for j in range(m + 1):
+                if used[j]:
+                    u[p[j]] += delta
+                    v[j] -= delta
+                else:
+                    minv[j] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+
+    assignment = [-1] * n
+    for j in range(1, m + 1):
+        if p[j]:
+            assignment[p[j] - 1] = j - 1
+    return assignment
+
+
+SOLVERS: dict[
+    str,
+    Callable[
+        [list[Ride], ChairGridIndex, MatchingConfig], list[tuple[Ride, IndexedChair]]
+    ],
+] = {
+    "greedy": assign_greedy,
+    "min_cost": assign_min_cost,
+}
+
+
+def assign(
+    source: MatchingSource, index: ChairGridIndex, ride: Ride, chair: IndexedChair
+) -> bool:
+    assigned = source.assign(ride, chair)
+    # 割り当てに失敗した椅子も他で使用中なので、空きに戻るまで候補から外す
+    index.set_free(chair.id, False)
+    return assigned
+
+
+def match_single(
+    source: MatchingSource, index: ChairGridIndex, config: MatchingConfig
+) -> MatchingResult:
+    result = MatchingResult(backlog=source.count_pending_rides())
+    rides = source.pending_rides(limit=1)
+    if not rides:
+        return result
+    ride = rides[0]
+
+    source.sync(index)
+    # 他のワーカーが割り当て済みだった椅子は飛ばして次に近い椅子を試す
+    for _, chair in rank_candidates(
+        index, ride.pickup_latitude, ride.pickup_longitude, config.strategy
+    ):
+        if assign(source, index, ride, chair):
+            result.matched = 1
+            break
+    return result
+
+
+def match_batch(
+    source: MatchingSource, index: ChairGridIndex, config: MatchingConfig
+) -> MatchingResult:
+    rides = source.pending_rides()
+    result = MatchingResult(backlog=len(rides))
+    if not rides:
+        return result
+
+    source.sync(index)
+    for _ in range(BATCH_MAX_ROUNDS):
+        # 空き椅子より多い分は古いライドを優先し、残りは次回に回す
+        rides = rides[: index.free_count()]
+        if not rides:
+            break
+        pairs = SOLVERS[config.solver](rides, index, config)
+        if not pairs:
+            break
+
+        assigned: set[str] = set()
+        for ride, chair in pairs:
+            if assign(source, index, ride, chair):
+                assigned.add(ride.id)
+        result.matched += len(assigned)
+        if len(assigned) == len(pairs):
+            break
+        # 使用中だった椅子は候補から外れたので、残りを割り当て直す
+        rides = [ride for ride in rides if ride.id not in assigned]
+    return result
+
+
+def run_matching(
+    source: MatchingSource,
+    index: ChairGridIndex,
+    config: MatchingConfig = DEFAULT_CONFIG,
+) -> MatchingResult:
+    if config.mode == "single":
+        return match_single(source, index, config)
+    return match_batch(source, index, config)
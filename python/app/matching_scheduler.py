@@ -0,0 +1,140 @@
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from dataclasses import dataclass
+
+from sqlalchemy import text
+
+from .chair_index import chair_index
+from .event_bus import event_bus
+from .matching import MatchingResult, SqlMatchingSource, run_matching
+from .notifications import chair_notifications
+from .sql import engine
+
+# マッチングを実行する間隔。0 以下ならスケジューラを起動しない
+MATCHING_INTERVAL_MS = int(os.getenv("ISUCON_MATCHING_INTERVAL_MS", "100"))
+
+# 全ワーカーで同時に1つだけマッチングを実行するためのロック名
+MATCHING_LOCK_NAME = "isuride_matching"
+
+# 統計に残す直近のtick数
+STATS_WINDOW = 100
+
+
+@dataclass(slots=True)
+class MatchingTick:
+    duration_ms: float
+    matched: int
+    backlog: int
+
+
+class MatchingStats:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.ticks = 0
+        self.skipped_ticks = 0
+        self.matched_total = 0
+        self.recent: deque[MatchingTick] = deque(maxlen=STATS_WINDOW)
+
+    def record(self, tick: MatchingTick) -> None:
+        with self._lock:
+            self.ticks += 1
+            self.matched_total += tick.matched
+            self.recent.append(tick)
+
+    def record_skipped(self) -> None:
+        with self._lock:
+            self.skipped_ticks += 1
+
+    def snapshot(self) -> tuple[int, int, int, list[MatchingTick]]:
+        with self._lock:
+            return (
+                self.ticks,
+                self.skipped_ticks,
+                self.matched_total,
+                list(self.recent),
+            )
+
+
+matching_stats = MatchingStats()
+
+
+def run_matching_tick() -> MatchingResult | None:
+    """
+    MySQLのアドバイザリロックを取れた場合だけマッチングを1回実行する。
+
+    他のワーカーが実行中でロックを取れなかった場合は None を返す。
+    ロックはマッチングのトランザクションをコミットしてから解放する。
+    """
+    with engine.connect() as conn:
+        acquired = conn.execute(
+            text("SELECT GET_LOCK(:name, 0)"), {"name": MATCHING_LOCK_NAME}
+        ).scalar()
+        conn.commit()
+        if acquired != 1:
+            matching_stats.record_skipped()
+            return None
+
+        try:
+            started = time.perf_counter()
+            source = SqlMatchingSource(conn)
+            try:
+                with conn.begin():
+                    result = run_matching(source, chair_index)
+            except Exception:
+                # ロールバックで椅子の確保も取り消されたので、インデックスでも空きに戻す。
+                # chair_availability の updated_at は変わらないので refresh() では戻らない
+                for chair_id in source.assigned_chair_ids:
+                    chair_index.set_free(chair_id, True)
+                raise
+            for chair_id in source.assigned_chair_ids:
+                event_bus.publish("chair_free", chair_id, False)
+                chair_notifications.publish(chair_id)
+            matching_stats.record(
+                MatchingTick(
+                    duration_ms=(time.perf_counter() - started) * 1000,
+                    matched=result.matched,
+                    backlog=result.backlog,
+                )
+            )
+            return result
+        finally:
+            conn.execute(
+                text("SELECT RELEASE_LOCK(:name)"), {"name": MATCHING_LOCK_NAME}
+            )
+            conn.commit()
+
+
+class MatchingScheduler:
+    def __init__(self, interval_ms: int) -> None:
+        self._interval = interval_ms / 1000
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="matching-scheduler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.wait(self._interval):
+            try:
+                run_matching_tick()
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+
+
+matching_scheduler = MatchingScheduler(MATCHING_INTERVAL_MS)
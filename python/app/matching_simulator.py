@@ -0,0 +1,414 @@
+"""
+マッチングのオフラインシミュレータ。
+
+合成した椅子・モデル・位置情報・配車リクエストに対して app.matching の
+マッチング処理を繰り返し実行し、スループットと割り当ての質を計測する。
+
+    python -m app.matching_simulator --chairs 500 --rides-per-tick 20
+    python -m app.matching_simulator --strategy eta --solver min_cost
+
+--source mysql を指定すると ISUCON_DB_* で指定したDBに合成データを書き込み、
+本番と同じ SqlMatchingSource 経由で実行する。使い捨てのDBに対して実行すること。
+"""
+
+import argparse
+import math
+import random
+import statistics
+import time
+from dataclasses import dataclass, replace
+from datetime import UTC, datetime
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+from ulid import ULID
+
+from .chair_index import CELL_SIZE, ChairGridIndex, IndexedChair
+from .chair_models import chair_model_cache
+from .location_ingest import BufferedLocation, write_locations
+from .matching import (
+    DEFAULT_CONFIG,
+    MatchingConfig,
+    MatchingResult,
+    SqlMatchingSource,
+    run_matching,
+)
+from .models import ChairModel, Ride
+from .sql import engine
+from .utils import calculate_distance, secure_random_str
+
+SYNTHETIC_MODELS = [
+    ChairModel(name="SimBasic", speed=2),
+    ChairModel(name="SimStandard", speed=3),
+    ChairModel(name="SimPremium", speed=5),
+]
+
+
+def _now() -> datetime:
+    return datetime.now(UTC).replace(tzinfo=None)
+
+
+@dataclass(slots=True)
+class SimChair:
+    id: str
+    model: str
+    speed: int
+    latitude: int
+    longitude: int
+    # 乗車中のライドが終わるtick。-1 なら空いている
+    busy_until: int = -1
+    destination: tuple[int, int] | None = None
+
+
+class MemoryMatchingSource:
+    def __init__(self) -> None:
+        self.rides: dict[str, Ride] = {}
+        self.assigned: list[tuple[Ride, str]] = []
+
+    def count_pending_rides(self) -> int:
+        return len(self.rides)
+
+    def pending_rides(self, limit: int | None = None) -> list[Ride]:
+        rides = list(self.rides.values())
+        return rides if limit is None else rides[:limit]
+
+    def sync(self, index: ChairGridIndex) -> None:
+        # シミュレータが椅子の変化を直接インデックスに反映するので何もしない
+        pass
+
+    def assign(self, ride: Ride, chair: IndexedChair) -> bool:
+        del self.rides[ride.id]
+        self.assigned.append((ride, chair.id))
+        return True
+
+
+class RecordingSqlMatchingSource(SqlMatchingSource):
+    def __init__(self, conn: Connection) -> None:
+        super().__init__(conn)
+        self.assigned: list[tuple[Ride, str]] = []
+
+    def assign(self, ride: Ride, chair: IndexedChair) -> bool:
+        if not super().assign(ride, chair):
+            return False
+        self.assigned.append((ride, chair.id))
+        return True
+
+
+class MemoryBackend:
+    name = "memory"
+
+    def __init__(self, index: ChairGridIndex) -> None:
+        self.index = index
+        self.source = MemoryMatchingSource()
+
+    def models(self) -> list[ChairModel]:
+        chair_model_cache.update(SYNTHETIC_MODELS)
+        return SYNTHETIC_MODELS
+
+    def add_chairs(self, chairs: list[SimChair]) -> None:
+        now = _now()
+        for chair in chairs:
+            self.index.upsert_chair(chair.id, f"sim-{chair.id[-8:]}", chair.model, True)
+            self.index.update_location(chair.id, chair.latitude, chair.longitude, now)
+
+    def add_rides(self, rides: list[Ride]) -> None:
+        for ride in rides:
+            self.source.rides[ride.id] = ride
+
+    def release(self, chair: SimChair) -> None:
+        self.index.update_location(chair.id, chair.latitude, chair.longitude, _now())
+        self.index.set_free(chair.id, True)
+
+    def run_tick(
+        self, config: MatchingConfig
+    ) -> tuple[MatchingResult, list[tuple[Ride, str]]]:
+        self.source.assigned = []
+        result = run_matching(self.source, self.index, config)
+        return result, self.source.assigned
+
+
+class MySQLBackend:
+    name = "mysql"
+
+    def __init__(self, index: ChairGridIndex) -> None:
+        self.index = index
+        self.owner_id = str(ULID())
+
+    def models(self) -> list[ChairModel]:
+        chair_model_cache.load()
+        with engine.begin() as conn:
+            rows = conn.execute(text("SELECT * FROM chair_models")).fetchall()
+        return [ChairModel.model_validate(row) for row in rows]
+
+    def add_chairs(self, chairs: list[SimChair]) -> None:
+        with engine.begin() as conn:
+            conn.execute(
+                text(
+                    "INSERT INTO chairs (id, owner_id, name, model, is_active, access_token) VALUES (:id, :owner_id, :name, :model, TRUE, :access_token)"
+                ),
+                [
+                    {
+                        "id": chair.id,
+                        "owner_id": self.owner_id,
+                        "name": f"sim-{chair.id[-8:]}",
+                        "model": chair.model,
+                        "access_token": secure_random_str(32),
+                    }
+                    for chair in chairs
+                ],
+            )
+            conn.execute(
+                text("INSERT INTO chair_availability (chair_id) VALUES (:chair_id)"),
+                [{"chair_id": chair.id} for chair in chairs],
+            )
+            for chair in chairs:
+                self._record_location(conn, chair)
+
+    def add_rides(self, rides: list[Ride]) -> None:
+        if not rides:
+            return
+        with engine.begin() as conn:
+            conn.execute(
+                text(
+                    "INSERT INTO rides (id, user_id, pickup_latitude, pickup_longitude, destination_latitude, destination_longitude) VALUES (:id, :user_id, :pickup_latitude, :pickup_longitude, :destination_latitude, :destination_longitude)"
+                ),
+                [
+                    ride.model_dump(
+                        include={
+                            "id",
+                            "user_id",
+                            "pickup_latitude",
+                            "pickup_longitude",
+                            "destination_latitude",
+                            "destination_longitude",
+                        }
+                    )
+                    for ride in rides
+                ],
+            )
+
+    def _record_location(self, conn: Connection, chair: SimChair) -> None:
+        write_locations(
+            conn,
+            [
+                BufferedLocation(
+                    id=str(ULID()),
+                    chair_id=chair.id,
+                    latitude=chair.latitude,
+                    longitude=chair.longitude,
+                    created_at=_now(),
+                )
+            ],
+        )
+
+    def release(self, chair: SimChair) -> None:
+        with engine.begin() as conn:
+            self._record_location(conn, chair)
+            conn.execute(
+                text(
+                    "UPDATE chair_availability SET ride_id = NULL WHERE chair_id = :chair_id"
+                ),
+                {"chair_id": chair.id},
+            )
+
+    def run_tick(
+        self, config: MatchingConfig
+    ) -> tuple[MatchingResult, list[tuple[Ride, str]]]:
+        with engine.begin() as conn:
+            source = RecordingSqlMatchingSource(conn)
+            result = run_matching(source, self.index, config)
+        return result, source.assigned
+
+
+@dataclass(slots=True)
+class SimulationReport:
+    ticks: int
+    requested: int
+    matched: int
+    matching_seconds: float
+    tick_ms: list[float]
+    pickup_distances: list[int]
+    pickup_etas: list[float]
+    wait_ticks: list[int]
+
+    def print(self, title: str) -> None:
+        def avg(values: list[int] | list[float]) -> float:
+            return statistics.fmean(values) if values else 0.0
+
+        def percentile(values: list[float], p: int) -> float:
+            if len(values) < 2:
+                return values[0] if values else 0.0
+            return statistics.quantiles(values, n=100)[p - 1]
+
+        throughput = (
+            self.matched / self.matching_seconds if self.matching_seconds else 0
+        )
+        print(title)
+        print(f"  ticks={self.ticks} requested={self.requested} matched={self.matched}")
+        print(f"  matches/sec={throughput:.1f}")
+        print(
+            f"  tick latency p50={percentile(self.tick_ms, 50):.2f}ms"
+            f" p99={percentile(self.tick_ms, 99):.2f}ms"
+        )
+        print(
+            f"  avg pickup distance={avg(self.pickup_distances):.2f}"
+            f" avg pickup eta={avg(self.pickup_etas):.2f}"
+            f" avg wait ticks={avg(self.wait_ticks):.2f}"
+        )
+
+
+def simulate(
+    backend: MemoryBackend | MySQLBackend,
+    config: MatchingConfig,
+    *,
+    chairs: int,
+    ticks: int,
+    rides_per_tick: int,
+    map_size: int,
+    steps_per_tick: int,
+    seed: int,
+) -> SimulationReport:
+    rng = random.Random(seed)
+
+    def coordinate() -> tuple[int, int]:
+        return rng.randint(-map_size, map_size), rng.randint(-map_size, map_size)
+
+    models = backend.models()
+    fleet: dict[str, SimChair] = {}
+    for _ in range(chairs):
+        model = rng.choice(models)
+        latitude, longitude = coordinate()
+        chair = SimChair(
+            id=str(ULID()),
+            model=model.name,
+            speed=model.speed,
+            latitude=latitude,
+            longitude=longitude,
+        )
+        fleet[chair.id] = chair
+    backend.add_chairs(list(fleet.values()))
+
+    report = SimulationReport(
+        ticks=ticks,
+        requested=0,
+        matched=0,
+        matching_seconds=0.0,
+        tick_ms=[],
+        pickup_distances=[],
+        pickup_etas=[],
+        wait_ticks=[],
+    )
+    requested_at: dict[str, int] = {}
+    for tick in range(ticks):
+        for chair in fleet.values():
+            if chair.busy_until == tick and chair.destination is not None:
+                chair.latitude, chair.longitude = chair.destination
+                chair.destination = None
+                chair.busy_until = -1
+                backend.release(chair)
+
+        rides = []
+        for _ in range(rides_per_tick):
+            pickup = coordinate()
+            destination = coordinate()
+            now = _now()
+            ride = Ride(
+                id=str(ULID()),
+                user_id=str(ULID()),
+                chair_id=None,
+                pickup_latitude=pickup[0],
+                pickup_longitude=pickup[1],
+                destination_latitude=destination[0],
+                destination_longitude=destination[1],
+                evaluation=None,
+                created_at=now,
+                updated_at=now,
+            )
+            rides.append(ride)
+            requested_at[ride.id] = tick
+        backend.add_rides(rides)
+        report.requested += len(rides)
+
+        started = time.perf_counter()
+        result, assigned = backend.run_tick(config)
+        elapsed = time.perf_counter() - started
+        report.matching_seconds += elapsed
+        report.tick_ms.append(elapsed * 1000)
+        report.matched += result.matched
+
+        for ride, chair_id in assigned:
+            chair = fleet[chair_id]
+            pickup_distance = calculate_distance(
+                chair.latitude,
+                chair.longitude,
+                ride.pickup_latitude,
+                ride.pickup_longitude,
+            )
+            trip_distance = calculate_distance(
+                ride.pickup_latitude,
+                ride.pickup_longitude,
+                ride.destination_latitude,
+                ride.destination_longitude,
+            )
+            report.pickup_distances.append(pickup_distance)
+            report.pickup_etas.append(pickup_distance / chair.speed)
+            report.wait_ticks.append(tick - requested_at.pop(ride.id))
+            # 1tick あたり steps_per_tick 回、モデルの速度ぶん移動する
+            travel_ticks = math.ceil(
+                (pickup_distance + trip_distance) / (chair.speed * steps_per_tick)
+            )
+            chair.busy_until = tick + max(travel_ticks, 1)
+            chair.destination = (ride.destination_latitude, ride.destination_longitude)
+
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--source", choices=["memory", "mysql"], default="memory")
+    parser.add_argument(
+        "--mode", choices=["single", "batch"], default=DEFAULT_CONFIG.mode
+    )
+    parser.add_argument(
+        "--strategy", choices=["distance", "eta"], default=DEFAULT_CONFIG.strategy
+    )
+    parser.add_argument(
+        "--solver", choices=["greedy", "min_cost"], default=DEFAULT_CONFIG.solver
+    )
+    parser.add_argument("--cell-size", type=int, default=CELL_SIZE)
+    parser.add_argument("--chairs", type=int, default=500)
+    parser.add_argument("--ticks", type=int, default=200)
+    parser.add_argument("--rides-per-tick", type=int, default=20)
+    parser.add_argument("--map-size", type=int, default=300)
+    parser.add_argument("--steps-per-tick", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    config = replace(
+        DEFAULT_CONFIG, mode=args.mode, strategy=args.strategy, solver=args.solver
+    )
+    index = ChairGridIndex(cell_size=args.cell_size)
+    backend: MemoryBackend | MySQLBackend
+    if args.source == "mysql":
+        backend = MySQLBackend(index)
+    else:
+        backend = MemoryBackend(index)
+
+    report = simulate(
+        backend,
+        config,
+        chairs=args.chairs,
+        ticks=args.ticks,
+        rides_per_tick=args.rides_per_tick,
+        map_size=args.map_size,
+        steps_per_tick=args.steps_per_tick,
+        seed=args.seed,
+    )
+    report.print(
+        f"source={backend.name} mode={config.mode} strategy={config.strategy}"
+        f" solver={config.solver} cell_size={index.cell_size}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -4,8 +4,10 @@ from typing import Annotated
 from fastapi import Cookie, HTTPException
 from sqlalchemy import text
 
+from .auth_cache import chair_cache, owner_cache, user_cache
 from .models import Chair, Owner, User
 from .sql import engine
+from .token_table import token_table
 
 
 def app_auth_middleware(app_session: Annotated[str | None, Cookie()] = None) -> User:
@@ -14,6 +16,14 @@ def app_auth_middleware(app_session: Annotated[str | None, Cookie()] = None) ->
             status_code=HTTPStatus.UNAUTHORIZED, detail="app_session cookie is required"
         )
 
+    user = user_cache.get(app_session)
+    if user is not None:
+        return user
+    user = token_table.get(User, app_session)
+    if user is not None:
+        user_cache.put(app_session, user)
+        return user
+
     with engine.begin() as conn:
         row = conn.execute(
             text("SELECT * FROM users WHERE access_token = :access_token"),
@@ -26,7 +36,9 @@ def app_auth_middleware(app_session: Annotated[str | None, Cookie()] = None) ->
             )
         user = User.model_validate(row)
 
-        return user
+    token_table.put(app_session, user, overwrite=False)
+    user_cache.put(app_session, user)
+    return user
 
 
 def owner_auth_middleware(
@@ -38,6 +50,14 @@ def owner_auth_middleware(
             detail="owner_session cookie is required",
         )
 
+    owner = owner_cache.get(owner_session)
+    if owner is not None:
+        return owner
+    owner = token_table.get(Owner, owner_session)
+    if owner is not None:
+        owner_cache.put(owner_session, owner)
+        return owner
+
     with engine.begin() as conn:
         row = conn.execute(
             text("SELECT * FROM owners WHERE access_token = :access_token"),
@@ -49,7 +69,11 @@ def owner_auth_middleware(
                 status_code=HTTPStatus.UNAUTHORIZED, detail="invalid access token"
             )
 
-        return Owner.model_validate(row)
+        owner = Owner.model_validate(row)
+
+    token_table.put(owner_session, owner, overwrite=False)
+    owner_cache.put(owner_session, owner)
+    return owner
 
 
 def chair_auth_middleware(
@@ -61,6 +85,14 @@ def chair_auth_middleware(
             detail="chair_session cookie is required",
         )
 
+    chair = chair_cache.get(chair_session)
+    if chair is not None:
+        return chair
+    chair = token_table.get(Chair, chair_session)
+    if chair is not None:
+        chair_cache.put(chair_session, chair)
+        return chair
+
     with engine.begin() as conn:
         row = conn.execute(
             text("SELECT * FROM chairs WHERE access_token = :access_token"),
@@ -72,4 +104,8 @@ def chair_auth_middleware(
                 status_code=HTTPStatus.UNAUTHORIZED, detail="invalid access token"
             )
 
-        return Chair.model_validate(row)
+        chair = Chair.model_validate(row)
+
+    token_table.put(chair_session, chair, overwrite=False)
+    chair_cache.put(chair_session, chair)
+    return chair
@@ -58,6 +58,7 @@ class Ride(BaseModel):
     destination_latitude: int
     destination_longitude: int
     evaluation: int | None
+    latest_status: str = "MATCHING"
     created_at: datetime
     updated_at: datetime
 
@@ -0,0 +1,110 @@
+import asyncio
+import os
+import threading
+from collections.abc import AsyncIterator, Callable, Iterator
+from contextlib import contextmanager
+
+from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel
+
+from .event_bus import event_bus
+
+# 通知ストリームが、イベントを受け取れなくてもDBを確認し直す間隔
+NOTIFICATION_POLL_INTERVAL_MS = int(
+    os.getenv("ISUCON_NOTIFICATION_POLL_INTERVAL_MS", "1000")
+)
+
+
+class Subscription:
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._loop = loop
+        self._event = asyncio.Event()
+
+    def wake(self) -> None:
+        self._loop.call_soon_threadsafe(self._event.set)
+
+    def clear(self) -> None:
+        self._event.clear()
+
+    async def wait(self, timeout: float) -> None:
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except TimeoutError:
+            pass
+
+
+class NotificationHub:
+    """
+    ユーザーや椅子ごとに、通知すべき変更があったことを待っているストリームを起こす。
+
+    publish() はライドの状態を書き込んだスレッドから、コミット後に呼び出す。
+    イベントバスで全ワーカーに配られ、購読側は内容を持たない合図として受け取って
+    送るものはDBから読み直す。
+    """
+
+    def __init__(self, topic: str) -> None:
+        self._topic = topic
+        self._lock = threading.Lock()
+        self._subscriptions: dict[str, set[Subscription]] = {}
+        event_bus.subscribe(topic, self._wake)
+
+    @contextmanager
+    def subscribe(self, key: str) -> Iterator[Subscription]:
+        subscription = Subscription(asyncio.get_running_loop())
+        with self._lock:
+            self._subscriptions.setdefault(key, set()).add(subscription)
+        try:
+            yield subscription
+        finally:
+            with self._lock:
+                subscriptions = self._subscriptions.get(key)
+                if subscriptions is not None:
+                    subscriptions.discard(subscription)
+                    if not subscriptions:
+                        del self._subscriptions[key]
+
+    def publish(self, key: str) -> None:
+        event_bus.publish(self._topic, key)
+
+    def _wake(self, key: str) -> None:
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(key, ()))
+        for subscription in subscriptions:
+            subscription.wake()
+
+
+# キーはユーザーID
+user_notifications = NotificationHub("user_notification")
+# キーは椅子ID
+chair_notifications = NotificationHub("chair_notification")
+
+
+def accepts_event_stream(request: Request) -> bool:
+    """text/event-stream を受け付けるクライアントにはストリームで、それ以外はポーリングで返す。"""
+    return "text/event-stream" in request.headers.get("accept", "")
+
+
+async def stream(
+    hub: NotificationHub,
+    key: str,
+    fetch: Callable[[str], tuple[BaseModel | None, bool]],
+) -> AsyncIterator[str]:
+    """
+    hub で key に合図があるたびに fetch で読み直し、Server-Sent Events で送る。
+
+    fetch は送る内容と、未送信の状態を送信済みにしたかを返す。
+    接続直後に現在の状態を送り、以降は未送信の状態ができたときだけ送る。
+    """
+    first = True
+    with hub.subscribe(key) as subscription:
+        while True:
+            # DBを読む前に合図を消しておけば、読んだ後に書かれた状態も取りこぼさない
+            subscription.clear()
+            data, fresh = await run_in_threadpool(fetch, key)
+            if data is not None and (fresh or first):
+                yield f"data: {data.model_dump_json(exclude_none=True)}\n\n"
+                first = False
+            if fresh:
+                continue
+            await subscription.wait(NOTIFICATION_POLL_INTERVAL_MS / 1000)
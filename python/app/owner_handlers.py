@@ -9,13 +9,14 @@ from pydantic import BaseModel
 from sqlalchemy import text
 from ulid import ULID
 
+from .chair_sales import get_owner_chair_sales
 from .middlewares import owner_auth_middleware
-from .models import Chair, Owner, Ride
+from .models import Owner
 from .sql import engine
+from .token_table import token_table
 from .utils import (
     datetime_fromtimestamp_millis,
     secure_random_str,
-    sum_sales,
     timestamp_millis,
 )
 
@@ -58,6 +59,13 @@ def owner_post_owners(
             },
         )
 
+        row = conn.execute(
+            text("SELECT * FROM owners WHERE id = :id"), {"id": owner_id}
+        ).fetchone()
+        owner = Owner.model_validate(row)
+
+    token_table.put(access_token, owner)
+
     response.set_cookie(path="/", key="owner_session", value=access_token)
 
     return OwnerPostOwnersResponse(
@@ -99,42 +107,22 @@ def owner_get_sales(
         until_dt = datetime_fromtimestamp_millis(until)
 
     with engine.begin() as conn:
-        rows = conn.execute(
-            text("SELECT * FROM chairs WHERE owner_id = :owner_id"),
-            {"owner_id": owner.id},
-        ).fetchall()
-        chairs = [Chair.model_validate(r) for r in rows]
+        chair_sales = get_owner_chair_sales(conn, owner.id, since_dt, until_dt)
 
-        res = OwnerGetSalesResponse(total_sales=0, chairs=[], models=[])
-        model_sales_by_model: MutableMapping[str, int] = defaultdict(int)
-        for chair in chairs:
-            rows = conn.execute(
-                text(
-                    "SELECT rides.* FROM rides JOIN ride_statuses ON rides.id = ride_statuses.ride_id WHERE chair_id = :chair_id AND status = 'COMPLETED' AND updated_at BETWEEN :since AND :until + INTERVAL 999 MICROSECOND"
-                ),
-                {
-                    "chair_id": chair.id,
-                    "since": since_dt,
-                    "until": until_dt,
-                },
-            ).fetchall()
-            rides = [Ride.model_validate(r) for r in rows]
+    res = OwnerGetSalesResponse(total_sales=0, chairs=[], models=[])
+    model_sales_by_model: MutableMapping[str, int] = defaultdict(int)
+    for chair_id, name, model, sales in chair_sales:
+        res.total_sales += sales
+        res.chairs.append(ChairSales(id=chair_id, name=name, sales=sales))
+        model_sales_by_model[model] += sales
 
-            chair_sales = sum_sales(rides)
+    model_sales = []
+    for model, sales in model_sales_by_model.items():
+        model_sales.append(ModelSales(model=model, sales=sales))
 
-            res.total_sales += chair_sales
-            res.chairs.append(
-                ChairSales(id=chair.id, name=chair.name, sales=chair_sales)
-            )
-            model_sales_by_model[chair.model] += chair_sales
+    res.models = model_sales
 
-        model_sales = []
-        for model, sales in model_sales_by_model.items():
-            model_sales.append(ModelSales(model=model, sales=sales))
-
-        res.models = model_sales
-
-        return res
+    return res
 
 
 class ChairWithDetail(BaseModel):
@@ -176,27 +164,19 @@ def owner_get_chairs(
         rows = conn.execute(
             text(
                 """
-                SELECT id,
-                       owner_id,
-                       name,
-                       access_token,
-                       model,
-                       is_active,
-                       created_at,
-                       updated_at,
-                       IFNULL(total_distance, 0) AS total_distance,
-                       total_distance_updated_at
+                SELECT chairs.id,
+                       chairs.owner_id,
+                       chairs.name,
+                       chairs.access_token,
+                       chairs.model,
+                       chairs.is_active,
+                       chairs.created_at,
+                       chairs.updated_at,
+                       IFNULL(chair_latest_location.total_distance, 0) AS total_distance,
+                       chair_latest_location.updated_at AS total_distance_updated_at
                 FROM chairs
-                       LEFT JOIN (SELECT chair_id,
-                                          SUM(IFNULL(distance, 0)) AS total_distance,
-                                          MAX(created_at)          AS total_distance_updated_at
-                                   FROM (SELECT chair_id,
-                                                created_at,
-                                                ABS(latitude - LAG(latitude) OVER (PARTITION BY chair_id ORDER BY created_at)) +
-                                                ABS(longitude - LAG(longitude) OVER (PARTITION BY chair_id ORDER BY created_at)) AS distance
-                                         FROM chair_locations) tmp
-                                   GROUP BY chair_id) distance_table ON distance_table.chair_id = chairs.id
-                WHERE owner_id = :owner_id
+                       LEFT JOIN chair_latest_location ON chair_latest_location.chair_id = chairs.id
+                WHERE chairs.owner_id = :owner_id
         """
             ),
             {"owner_id": owner.id},
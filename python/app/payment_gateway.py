@@ -6,8 +6,6 @@ import json
 import urllib3
 from pydantic import BaseModel, ValidationError
 
-from .models import Ride
-
 
 class UpstreamError(Exception):
     """上流サービスでの予期しないエラーを表す例外クラス。"""
@@ -31,19 +29,23 @@ def request_payment_gateway_post_payment(
     payment_gateway_url: str,
     token: str,
     param: PaymentGatewayPostPaymentRequest,
-    retrieve_rides_order_by_created_at_asc: Callable[[], list[Ride]],
+    idempotency_key: str,
+    count_completed_rides: Callable[[], int],
 ) -> None:
     """
     決済ゲートウェイに支払いリクエストを送信し、必要に応じてリトライを行う。
 
+    同じ支払いには同じ冪等キーを付けて送るので、リトライしても二重に請求されない。
+
     Args:
         payment_gateway_url (str): 決済ゲートウェイのベースURL。
         token (str): 認証トークン。
         param (PaymentGatewayPostPaymentRequest): 支払いリクエストパラメータ。
-        retrieve_rides_order_by_created_at_asc (Callable[[], list[Ride]]): ライドを取得する関数。
+        idempotency_key (str): 支払いごとの冪等キー。ライドIDを使う。
+        count_completed_rides (Callable[[], int]): ユーザーの完了したライド数を返す関数。
 
     Raises:
-        UpstreamError: 支払いとライドの数が一致しない場合。
+        UpstreamError: 支払いと完了したライドの数が一致しない場合。
         RuntimeError: GET /payments が予期しないステータスコードを返した場合。
         Exception: 最大リトライ回数を超えた場合。
     """
@@ -57,6 +59,7 @@ def request_payment_gateway_post_payment(
             headers = {
                 "Content-Type": "application/json",
                 "Authorization": f"Bearer {token}",
+                "Idempotency-Key": idempotency_key,
             }
             encoded_data = json.dumps(param.dict()).encode('utf-8')
             res = http.request(
@@ -99,11 +102,11 @@ def request_payment_gateway_post_payment(
                 except ValidationError as e:
                     raise UpstreamError("Invalid payment data from upstream") from e
 
-                rides = retrieve_rides_order_by_created_at_asc()
+                completed_rides = count_completed_rides()
 
-                if len(rides) != len(payments):
+                if completed_rides != len(payments):
                     raise UpstreamError(
-                        f"unexpected number of payments: {len(rides)} != {len(payments)}. errored upstream"
+                        f"unexpected number of payments: {completed_rides} != {len(payments)}. errored upstream"
                     )
             # 成功した場合はループを抜ける
             return
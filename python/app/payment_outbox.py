@@ -0,0 +1,227 @@
+import os
+import sys
+import threading
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.engine import Connection
+
+from .payment_gateway import (
+    PaymentGatewayPostPaymentRequest,
+    request_payment_gateway_post_payment,
+)
+from .sql import engine
+from .user_ride_counts import count_completed_rides
+
+# 送信待ちの支払いを確認する間隔。0 以下ならこのワーカーでは送信しない
+PAYMENT_DISPATCH_INTERVAL_MS = int(
+    os.getenv("ISUCON_PAYMENT_DISPATCH_INTERVAL_MS", "100")
+)
+
+# 同時に決済ゲートウェイへ送る支払いの数
+PAYMENT_DISPATCH_CONCURRENCY = int(
+    os.getenv("ISUCON_PAYMENT_DISPATCH_CONCURRENCY", "8")
+)
+
+# この回数送っても成功しなければ FAILED にして送り直さない
+PAYMENT_MAX_ATTEMPTS = int(os.getenv("ISUCON_PAYMENT_MAX_ATTEMPTS", "10"))
+
+# 送信中の支払いを他のワーカーが拾わない秒数。送信中に落ちたワーカーの分はこの後に送り直す。
+# 決済ゲートウェイへの1回の送信はリトライとタイムアウトを含めて最大90秒ほどかかる
+PAYMENT_LEASE_SEC = 120
+
+# 失敗した支払いを送り直すまでの最大秒数
+PAYMENT_MAX_BACKOFF_SEC = 60
+
+
+@dataclass(slots=True)
+class PendingPayment:
+    ride_id: str
+    user_id: str
+    token: str
+    amount: int
+    attempts: int
+
+
+def enqueue_payment(
+    conn: Connection, ride_id: str, user_id: str, token: str, amount: int
+) -> None:
+    """ライドの支払いを送信待ちにする。COMPLETED を書き込むのと同じトランザクションで呼ぶ。"""
+    conn.execute(
+        text(
+            "INSERT INTO payment_outbox (ride_id, user_id, token, amount) VALUES (:ride_id, :user_id, :token, :amount)"
+        ),
+        {"ride_id": ride_id, "user_id": user_id, "token": token, "amount": amount},
+    )
+
+
+def claim_payments(limit: int) -> tuple[str, list[PendingPayment]]:
+    """
+    送信できる支払いを最大 limit 件取り、PAYMENT_LEASE_SEC の間は他のワーカーに渡さない。
+
+    決済ゲートウェイのURLも合わせて返す。
+    """
+    with engine.begin() as conn:
+        rows = conn.execute(
+            text(
+                "SELECT ride_id, user_id, token, amount, attempts FROM payment_outbox WHERE status = 'PENDING' AND next_attempt_at <= CURRENT_TIMESTAMP(6) ORDER BY next_attempt_at LIMIT :limit FOR UPDATE SKIP LOCKED"
+            ),
+            {"limit": limit},
+        ).fetchall()
+        payments = [
+            PendingPayment(
+                ride_id=row.ride_id,
+                user_id=row.user_id,
+                token=row.token,
+                amount=row.amount,
+                attempts=row.attempts,
+            )
+            for row in rows
+        ]
+        if not payments:
+            return "", []
+
+        conn.execute(
+            text(
+                "UPDATE payment_outbox SET next_attempt_at = CURRENT_TIMESTAMP(6) + INTERVAL :lease SECOND WHERE ride_id IN :ride_ids"
+            ).bindparams(bindparam("ride_ids", expanding=True)),
+            {
+                "lease": PAYMENT_LEASE_SEC,
+                "ride_ids": [payment.ride_id for payment in payments],
+            },
+        )
+        payment_gateway_url = conn.execute(
+            text("SELECT value FROM settings WHERE name = 'payment_gateway_url'")
+        ).scalar_one()
+    return payment_gateway_url, payments
+
+
+def send_payment(payment_gateway_url: str, payment: PendingPayment) -> None:
+    """支払いを決済ゲートウェイへ送り、結果を payment_outbox に書き込む。"""
+
+    def count_user_completed_rides() -> int:
+        with engine.begin() as conn:
+            return count_completed_rides(conn, payment.user_id)
+
+    try:
+        request_payment_gateway_post_payment(
+            payment_gateway_url,
+            payment.token,
+            PaymentGatewayPostPaymentRequest(amount=payment.amount),
+            payment.ride_id,
+            count_user_completed_rides,
+        )
+    except Exception as e:
+        attempts = payment.attempts + 1
+        with engine.begin() as conn:
+            conn.execute(
+                text(
+                    "UPDATE payment_outbox SET status = :status, attempts = :attempts, last_error = :last_error, next_attempt_at = CURRENT_TIMESTAMP(6) + INTERVAL :backoff SECOND WHERE ride_id = :ride_id"
+                ),
+                {
+                    "status": "FAILED"
+                    if attempts >= PAYMENT_MAX_ATTEMPTS
+                    else "PENDING",
+                    "attempts": attempts,
+                    "last_error": repr(e),
+                    "backoff": min(2**attempts, PAYMENT_MAX_BACKOFF_SEC),
+                    "ride_id": payment.ride_id,
+                },
+            )
+        raise
+
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "UPDATE payment_outbox SET status = 'SUCCEEDED', attempts = attempts + 1, last_error = NULL WHERE ride_id = :ride_id"
+            ),
+            {"ride_id": payment.ride_id},
+        )
+
+
+class PaymentDispatcher:
+    """
+    payment_outbox に溜まった支払いを、バックグラウンドで決済ゲートウェイへ送る。
+
+    全ワーカーで動かし、SKIP LOCKED で同じ支払いを取り合わないようにする。
+    送信はスレッドプールで並行に行い、空きができた分だけ次の支払いを取る。
+    """
+
+    def __init__(self, interval_ms: int, concurrency: int) -> None:
+        self._interval = interval_ms / 1000
+        self._concurrency = concurrency
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._pool: ThreadPoolExecutor | None = None
+        self._thread: threading.Thread | None = None
+
+    def wake(self) -> None:
+        """支払いを送信待ちにしたトランザクションのコミット後に呼ぶと、すぐに送り始める。"""
+        self._wake.set()
+
+    def start(self) -> None:
+        if self._thread is not None or self._interval <= 0:
+            return
+        self._stop.clear()
+        self._pool = ThreadPoolExecutor(
+            max_workers=self._concurrency, thread_name_prefix="payment-sender"
+        )
+        self._thread = threading.Thread(
+            target=self._run, name="payment-dispatcher", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    def dispatch(self) -> int:
+        """空いている分だけ支払いを取り、送信を始めた件数を返す。"""
+        assert self._pool is not None
+        with self._lock:
+            free = self._concurrency - self._in_flight
+        if free <= 0:
+            return 0
+        payment_gateway_url, payments = claim_payments(free)
+        for payment in payments:
+            with self._lock:
+                self._in_flight += 1
+            future = self._pool.submit(send_payment, payment_gateway_url, payment)
+            future.add_done_callback(self._on_sent)
+        return len(payments)
+
+    def _on_sent(self, future: Future[None]) -> None:
+        with self._lock:
+            self._in_flight -= 1
+        exc = future.exception()
+        if exc is not None:
+            traceback.print_exception(exc, file=sys.stderr)
+        self._wake.set()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(self._interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            try:
+                # 取り切れなかった支払いがあれば待たずに続けて取る
+                if self.dispatch() > 0:
+                    self._wake.set()
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+
+
+payment_dispatcher = PaymentDispatcher(
+    PAYMENT_DISPATCH_INTERVAL_MS, PAYMENT_DISPATCH_CONCURRENCY
+)
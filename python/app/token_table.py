@@ -0,0 +1,185 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+from pydantic import BaseModel, ValidationError
+
+from .models import Chair, Owner, User
+
+# 全ワーカーで共有するアクセストークン表のファイル。tmpfs に置けばディスクに書かれない
+TOKEN_TABLE_PATH = os.getenv(
+    "ISUCON_TOKEN_TABLE_PATH",
+    os.path.join(
+        "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+        "isuride-tokens",
+    ),
+)
+
+# 表のスロット数。ファイルは疎に確保されるので、使った分だけメモリを消費する
+TOKEN_TABLE_SLOTS = int(os.getenv("ISUCON_TOKEN_TABLE_SLOTS", "131072"))
+
+# 1つのトークンについて探す最大スロット数。これを超えたら表には載せずDBから読む
+MAX_PROBES = 32
+
+# 書き込み中のスロットを読み直す最大回数。書き手が途中で落ちていてもDBから読めるようにする
+MAX_READ_RETRIES = 1000
+
+ROLE_USER = 1
+ROLE_OWNER = 2
+ROLE_CHAIR = 3
+
+ROLES: dict[type[BaseModel], int] = {
+    User: ROLE_USER,
+    Owner: ROLE_OWNER,
+    Chair: ROLE_CHAIR,
+}
+
+# ヘッダ: 世代(u64)
+HEADER = struct.Struct("<Q")
+HEADER_SIZE = 64
+
+# スロット: 書き込み中なら奇数になる版数(u32), 世代(u64), 役割(u8), トークン長(u8), 本体長(u16)
+SLOT = struct.Struct("<IQBBH")
+VERSION = struct.Struct("<I")
+SLOT_SIZE = 1024
+MAX_TOKEN_SIZE = 128
+MAX_PAYLOAD_SIZE = SLOT_SIZE - SLOT.size - MAX_TOKEN_SIZE
+
+
+class TokenTable:
+    """
+    アクセストークンから認証したユーザー・オーナー・椅子の行を引く、全ワーカー共有のハッシュ表。
+
+    メモリマップしたファイル上の開番地法の表で、各スロットにトークンと行の JSON を持つ。
+    書き込みはファイルロックで直列化し、読み込みはロックを取らずにスロットの版数が
+    読む前後で変わっていないことだけを確かめる。表を空にするときは世代を進め、
+    古い世代のスロットを空きとして扱う。
+    """
+
+    def __init__(self, path: str, slots: int) -> None:
+        self._path = path
+        self._slots = slots
+        self._lock = threading.Lock()
+        self._fd: int | None = None
+        self._map: mmap.mmap | None = None
+
+    def _ensure_open(self) -> mmap.mmap:
+        if self._map is not None:
+            return self._map
+        with self._lock:
+            if self._map is None:
+                size = HEADER_SIZE + self._slots * SLOT_SIZE
+                fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    if os.fstat(fd).st_size < size:
+                        os.ftruncate(fd, size)
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                self._fd = fd
+                self._map = mmap.mmap(fd, size)
+            return self._map
+
+    def _slot_indexes(self, token: bytes) -> list[int]:
+        h = int.from_bytes(hashlib.blake2b(token, digest_size=8).digest(), "little")
+        return [(h + i) % self._slots for i in range(min(MAX_PROBES, self._slots))]
+
+    def get[T: BaseModel](self, model: type[T], token: str) -> T | None:
+        m = self._ensure_open()
+        key = token.encode()
+        if len(key) > MAX_TOKEN_SIZE:
+            return None
+        (generation,) = HEADER.unpack_from(m, 0)
+        role = ROLES[model]
+        for index in self._slot_indexes(key):
+            offset = HEADER_SIZE + index * SLOT_SIZE
+            for _ in range(MAX_READ_RETRIES):
+                version, slot_generation, slot_role, token_len, payload_len = (
+                    SLOT.unpack_from(m, offset)
+                )
+                if version % 2 == 1:
+                    continue
+                body = offset + SLOT.size
+                slot_token = m[body : body + token_len]
+                payload = m[body + MAX_TOKEN_SIZE : body + MAX_TOKEN_SIZE + payload_len]
+                if SLOT.unpack_from(m, offset)[0] == version:
+                    break
+            else:
+                return None
+            if slot_generation != generation or slot_role == 0:
+                # 空きスロットまで来たら、この先には無い
+                return None
+            if slot_role == role and slot_token == key:
+                try:
+                    return model.model_validate_json(payload)
+                except ValidationError:
+                    # 壊れたスロットは載っていないものとして扱い、DBから読ませる
+                    return None
+        return None
+
+    def put(self, token: str, principal: BaseModel, overwrite: bool = True) -> None:
+        """
+        トークンの行を書き込む。
+
+        行を登録・更新した時点で呼べば、全ワーカーの認証がDBを引かずに済む。
+        overwrite が False なら既に載っているトークンはそのままにする。DBから読んだ行を
+        載せるときに、その間に書き込まれた新しい行を古い行で上書きしないために使う。
+        """
+        m = self._ensure_open()
+        key = token.encode()
+        payload = principal.model_dump_json().encode()
+        if len(key) > MAX_TOKEN_SIZE or len(payload) > MAX_PAYLOAD_SIZE:
+            return
+        role = ROLES[type(principal)]
+        assert self._fd is not None
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                (generation,) = HEADER.unpack_from(m, 0)
+                for index in self._slot_indexes(key):
+                    offset = HEADER_SIZE + index * SLOT_SIZE
+                    version, slot_generation, slot_role, token_len, _ = (
+                        SLOT.unpack_from(m, offset)
+                    )
+                    body = offset + SLOT.size
+                    empty = slot_generation != generation or slot_role == 0
+                    if not empty and not (
+                        slot_role == role and m[body : body + token_len] == key
+                    ):
+                        continue
+                    if not empty and not overwrite:
+                        return
+                    # 版数を奇数にしてからヘッダの残りと本体を書き換え、最後に版数だけを
+                    # 偶数に戻して読み手に公開する。版数とヘッダを一度に書くと、偶数の版数と
+                    # 書きかけの長さを組み合わせて読まれることがある
+                    writing = (version + 1) & 0xFFFFFFFF
+                    VERSION.pack_into(m, offset, writing)
+                    m[body : body + len(key)] = key
+                    m[body + MAX_TOKEN_SIZE : body + MAX_TOKEN_SIZE + len(payload)] = (
+                        payload
+                    )
+                    SLOT.pack_into(
+                        m, offset, writing, generation, role, len(key), len(payload)
+                    )
+                    VERSION.pack_into(m, offset, (version + 2) & 0xFFFFFFFF)
+                    return
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def clear(self) -> None:
+        m = self._ensure_open()
+        assert self._fd is not None
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                (generation,) = HEADER.unpack_from(m, 0)
+                HEADER.pack_into(m, 0, generation + 1)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+token_table = TokenTable(TOKEN_TABLE_PATH, TOKEN_TABLE_SLOTS)
@@ -0,0 +1,43 @@
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+# user_ride_counts はユーザーごとの進行中のライド数と、これまでに要求したライドの総数。
+# ライドの要求で両方を増やし、評価して COMPLETED にした時点で進行中の数を戻す。
+
+
+def register_user(conn: Connection, user_id: str) -> None:
+    conn.execute(
+        text("INSERT INTO user_ride_counts (user_id) VALUES (:user_id)"),
+        {"user_id": user_id},
+    )
+
+
+def start_ride(conn: Connection, user_id: str) -> bool:
+    """進行中のライドが無ければ数を進めて True を返す。既に進行中のライドがあれば False。"""
+    result = conn.execute(
+        text(
+            "UPDATE user_ride_counts SET active_rides_count = active_rides_count + 1, total_rides_count = total_rides_count + 1 WHERE user_id = :user_id AND active_rides_count = 0"
+        ),
+        {"user_id": user_id},
+    )
+    return result.rowcount == 1
+
+
+def finish_ride(conn: Connection, user_id: str) -> None:
+    conn.execute(
+        text(
+            "UPDATE user_ride_counts SET active_rides_count = active_rides_count - 1 WHERE user_id = :user_id AND active_rides_count > 0"
+        ),
+        {"user_id": user_id},
+    )
+
+
+def count_completed_rides(conn: Connection, user_id: str) -> int:
+    """ユーザーの完了したライド数。支払いの数との突き合わせに使う。"""
+    count = conn.execute(
+        text(
+            "SELECT total_rides_count - active_rides_count FROM user_ride_counts WHERE user_id = :user_id"
+        ),
+        {"user_id": user_id},
+    ).scalar()
+    return int(count or 0)
@@ -13,6 +13,7 @@ def mypy(session: nox.Session) -> None:
         "mypy",
         "cryptography",
         "fastapi",
+        "numpy",
         "python-ulid",
         "sqlalchemy",
         "urllib3",
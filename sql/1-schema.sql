@@ -37,6 +37,7 @@ CREATE TABLE chairs
   COMMENT = '椅子情報テーブル';
 ALTER TABLE chairs ADD INDEX idx_chairs_owner_id (owner_id);
 ALTER TABLE chairs ADD INDEX idx_chairs_access_token (access_token);
+ALTER TABLE chairs ADD INDEX idx_chairs_updated_at (updated_at);
 
 
 DROP TABLE IF EXISTS chair_locations;
@@ -51,9 +52,85 @@ CREATE TABLE chair_locations
 )
   COMMENT = '椅子の現在位置情報テーブル';
 ALTER TABLE chair_locations ADD INDEX idx_chair_id (chair_id);
+ALTER TABLE chair_locations ADD INDEX idx_chair_id_created_at (chair_id, created_at);
 ALTER TABLE chair_locations ADD INDEX idx_latitude (latitude);
 ALTER TABLE chair_locations ADD INDEX idx_longitude (longitude);
 
+DROP TABLE IF EXISTS chair_latest_location;
+CREATE TABLE chair_latest_location
+(
+  chair_id   VARCHAR(26) NOT NULL COMMENT '椅子ID',
+  latitude   INTEGER     NOT NULL COMMENT '経度',
+  longitude  INTEGER     NOT NULL COMMENT '緯度',
+  total_distance INTEGER NOT NULL DEFAULT 0 COMMENT '総移動距離',
+  updated_at DATETIME(6) NOT NULL COMMENT '最新の位置情報の登録日時',
+  PRIMARY KEY (chair_id)
+)
+  COMMENT = '椅子の最新位置情報と総移動距離テーブル';
+ALTER TABLE chair_latest_location ADD INDEX idx_updated_at (updated_at);
+
+
+DROP TABLE IF EXISTS chair_availability;
+CREATE TABLE chair_availability
+(
+  chair_id   VARCHAR(26) NOT NULL COMMENT '椅子ID',
+  ride_id    VARCHAR(26) NULL     COMMENT '対応中のライドID(NULLなら空き)',
+  updated_at DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6) COMMENT '更新日時',
+  PRIMARY KEY (chair_id)
+)
+  COMMENT = '椅子の空き状況テーブル';
+ALTER TABLE chair_availability ADD INDEX idx_updated_at (updated_at);
+
+
+DROP TABLE IF EXISTS chair_stats;
+CREATE TABLE chair_stats
+(
+  chair_id          VARCHAR(26) NOT NULL COMMENT '椅子ID',
+  total_rides_count INTEGER     NOT NULL DEFAULT 0 COMMENT '完了したライド数',
+  total_evaluation  INTEGER     NOT NULL DEFAULT 0 COMMENT '完了したライドの評価の合計',
+  PRIMARY KEY (chair_id)
+)
+  COMMENT = '椅子の評価集計テーブル';
+
+DROP TABLE IF EXISTS chair_sales;
+CREATE TABLE chair_sales
+(
+  chair_id         VARCHAR(26) NOT NULL COMMENT '椅子ID',
+  completed_at     DATETIME(3) NOT NULL COMMENT 'ライドの完了日時(ミリ秒単位)',
+  sales            BIGINT      NOT NULL COMMENT 'この時刻に完了したライドの売上',
+  cumulative_sales BIGINT      NOT NULL COMMENT 'この時刻までの売上の累積和',
+  PRIMARY KEY (chair_id, completed_at)
+)
+  COMMENT = '椅子の売上集計テーブル';
+
+DROP TABLE IF EXISTS user_ride_counts;
+CREATE TABLE user_ride_counts
+(
+  user_id            VARCHAR(26) NOT NULL COMMENT 'ユーザーID',
+  active_rides_count INTEGER     NOT NULL DEFAULT 0 COMMENT '完了していないライド数',
+  total_rides_count  INTEGER     NOT NULL DEFAULT 0 COMMENT '要求したライドの総数',
+  PRIMARY KEY (user_id)
+)
+  COMMENT = 'ユーザーのライド数集計テーブル';
+
+DROP TABLE IF EXISTS payment_outbox;
+CREATE TABLE payment_outbox
+(
+  ride_id         VARCHAR(26)                               NOT NULL COMMENT 'ライドID',
+  user_id         VARCHAR(26)                               NOT NULL COMMENT 'ユーザーID',
+  token           VARCHAR(255)                              NOT NULL COMMENT '決済トークン',
+  amount          INTEGER                                   NOT NULL COMMENT '支払い金額',
+  status          ENUM ('PENDING', 'SUCCEEDED', 'FAILED') NOT NULL DEFAULT 'PENDING' COMMENT '送信状態',
+  attempts        INTEGER                                   NOT NULL DEFAULT 0 COMMENT '送信した回数',
+  last_error      TEXT                                      NULL COMMENT '最後の送信で起きたエラー',
+  next_attempt_at DATETIME(6)                               NOT NULL DEFAULT CURRENT_TIMESTAMP(6) COMMENT '次に送信できる日時',
+  created_at      DATETIME(6)                               NOT NULL DEFAULT CURRENT_TIMESTAMP(6) COMMENT '登録日時',
+  updated_at      DATETIME(6)                               NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6) COMMENT '更新日時',
+  PRIMARY KEY (ride_id)
+)
+  COMMENT = '決済ゲートウェイへの送信待ちの支払いテーブル';
+ALTER TABLE payment_outbox ADD INDEX idx_status_next_attempt_at (status, next_attempt_at);
+
 
 DROP TABLE IF EXISTS users;
 CREATE TABLE users
@@ -105,7 +182,7 @@ CREATE TABLE rides
   PRIMARY KEY (id)
 )
   COMMENT = 'ライド情報テーブル';
-ALTER TABLE rides ADD INDEX idx_user_id (user_id);
+ALTER TABLE rides ADD INDEX idx_user_id_created_at (user_id, created_at);
 ALTER TABLE rides ADD INDEX idx_chair_id (chair_id);
 ALTER TABLE rides ADD INDEX idx_pickup_latitude (pickup_latitude);
 ALTER TABLE rides ADD INDEX idx_pickup_longitude (pickup_longitude);
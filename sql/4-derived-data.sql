@@ -0,0 +1,77 @@
+SET CHARACTER_SET_CLIENT = utf8mb4;
+SET CHARACTER_SET_CONNECTION = utf8mb4;
+
+USE isuride;
+
+-- ライドごとの最新の状態。初期データの INSERT が列を指定していないので、読み込み後に列を足す
+ALTER TABLE rides ADD COLUMN latest_status ENUM ('MATCHING', 'ENROUTE', 'PICKUP', 'CARRYING', 'ARRIVED', 'COMPLETED') NOT NULL DEFAULT 'MATCHING' COMMENT '最新の状態' AFTER evaluation;
+UPDATE rides
+  JOIN (SELECT ride_id, status
+        FROM (SELECT ride_id,
+                     status,
+                     ROW_NUMBER() OVER (PARTITION BY ride_id ORDER BY created_at DESC) AS n
+              FROM ride_statuses) statuses
+        WHERE n = 1) latest ON latest.ride_id = rides.id
+SET rides.latest_status = latest.status,
+    rides.updated_at    = rides.updated_at;
+
+-- 椅子への通知が6回(MATCHING〜COMPLETED)済んでいないライドがあれば、その椅子は使用中
+INSERT INTO chair_availability (chair_id, ride_id)
+SELECT chairs.id,
+       (SELECT rides.id
+        FROM rides
+        WHERE rides.chair_id = chairs.id
+          AND (SELECT COUNT(ride_statuses.chair_sent_at)
+               FROM ride_statuses
+               WHERE ride_statuses.ride_id = rides.id) < 6
+        ORDER BY rides.updated_at DESC
+        LIMIT 1)
+FROM chairs;
+
+-- 椅子ごとの最新の位置情報と総移動距離
+INSERT INTO chair_latest_location (chair_id, latitude, longitude, total_distance, updated_at)
+SELECT chair_id, latitude, longitude, total_distance, created_at
+FROM (SELECT chair_id,
+             latitude,
+             longitude,
+             created_at,
+             SUM(IFNULL(distance, 0)) OVER (PARTITION BY chair_id) AS total_distance,
+             ROW_NUMBER() OVER (PARTITION BY chair_id ORDER BY created_at DESC) AS n
+      FROM (SELECT chair_id,
+                   latitude,
+                   longitude,
+                   created_at,
+                   ABS(latitude - LAG(latitude) OVER (PARTITION BY chair_id ORDER BY created_at)) +
+                   ABS(longitude - LAG(longitude) OVER (PARTITION BY chair_id ORDER BY created_at)) AS distance
+            FROM chair_locations) tmp) latest
+WHERE n = 1;
+
+-- 椅子ごとの完了したライド数と評価の合計
+INSERT INTO chair_stats (chair_id, total_rides_count, total_evaluation)
+SELECT chair_id, COUNT(*), SUM(evaluation)
+FROM rides
+WHERE latest_status = 'COMPLETED'
+GROUP BY chair_id;
+
+-- 椅子ごと・完了時刻のミリ秒ごとの売上と、その累積和
+INSERT INTO chair_sales (chair_id, completed_at, sales, cumulative_sales)
+SELECT chair_id,
+       completed_at,
+       sales,
+       SUM(sales) OVER (PARTITION BY chair_id ORDER BY completed_at)
+FROM (SELECT chair_id,
+             TIMESTAMPADD(MICROSECOND, -(MICROSECOND(updated_at) % 1000), updated_at) AS completed_at,
+             SUM(500 + 100 * (ABS(pickup_latitude - destination_latitude) +
+                              ABS(pickup_longitude - destination_longitude))) AS sales
+      FROM rides
+      WHERE latest_status = 'COMPLETED'
+      GROUP BY chair_id, completed_at) buckets;
+
+-- ユーザーごとの完了していないライド数と、要求したライドの総数
+INSERT INTO user_ride_counts (user_id, active_rides_count, total_rides_count)
+SELECT users.id,
+       IFNULL(SUM(rides.latest_status <> 'COMPLETED'), 0),
+       COUNT(rides.id)
+FROM users
+       LEFT JOIN rides ON rides.user_id = users.id
+GROUP BY users.id;